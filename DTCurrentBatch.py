@@ -0,0 +1,152 @@
+import os
+import csv
+import glob
+import json
+import argparse
+import functools
+import multiprocessing
+import numpy as np
+import DTCurrentData
+
+# processes many fill dirs (or fill archives): loads data, writes summary table and plots of each fill
+# fills are processed in a process pool, fills with unchanged files are skipped
+# usage:
+# python DTCurrentBatch.py 'fills/*/' --workers 4 --summary summary.csv
+
+# summary and manifest files written in each fill dir (in <archive name>.dtcurrent/ next to a fill archive)
+SUMMARY_FILE = 'dtcurrent_summary.json'
+MANIFEST_FILE = '.dtcurrent_batch.json'
+
+# increase when summary or plots change (all fills are processed again)
+BATCH_VERSION = 1
+
+# summary table columns
+COLUMNS = ['fill', 'wheel', 'station', 'sector', 'slope_wires', 'slope_cathode', 'maxcurrent_wires', 'maxcurrent_cathode']
+
+# slope and maxcurrent of wires and cathode for each loaded chamber
+def summarize(data):
+	values = {}
+	for wire in ['wires', 'cathode']:
+		_, values['slope_' + wire] = data.aggregate(stat='slope', by=('wheel', 'station', 'sector'), wire=wire)
+		_, values['maxcurrent_' + wire] = data.aggregate(stat='maxcurrent', by=('wheel', 'station', 'sector'), wire=wire)
+	
+	rows = []
+	for wheel, station, sector in zip(*np.nonzero(np.isfinite(values['maxcurrent_wires']))):
+		row = {'fill': data.fill, 'wheel': int(data.valid_wheels[wheel]), 'station': int(data.valid_stations[station]), 'sector': int(data.valid_sectors[sector])}
+		for name in values:
+			value = float(values[name][wheel, station, sector])
+			row[name] = value if np.isfinite(value) else None
+		rows.append(row)
+	return {'fill': data.fill, 'rows': len(data.luminosity), 'chambers': rows}
+
+# return True if files of the fill have not changed since the last run and all outputs exist (path: output dir of the fill)
+def up_to_date(path, inputs):
+	try:
+		with open(path + MANIFEST_FILE) as fp:
+			manifest = json.load(fp)
+	except (IOError, OSError, ValueError):
+		return False
+	if manifest.get('inputs') != inputs:
+		return False
+	return all(os.path.exists(path + output) for output in manifest.get('outputs', []))
+
+# load one fill, write summary and plots (plots=False: only summary), returns summary or None if processing failed
+def process_fill(path, plots=True, force=False, options={}):
+	path = path.rstrip('/')+'/'
+	filenames = DTCurrentData.data_files(path)
+	if not filenames:
+		print('No data files in ' + path)
+		return
+	
+	# skip fill if files have not changed
+	output = DTCurrentData.output_dir(path)
+	inputs = dict(DTCurrentData.cache_manifest(filenames), options=options, plots=plots, batch_version=BATCH_VERSION)
+	if not force and up_to_date(output, inputs):
+		with open(output + SUMMARY_FILE) as fp:
+			print('Skipped ' + path)
+			return json.load(fp)
+	
+	try:
+		outputs = [SUMMARY_FILE]
+		if plots:
+			import DTCurrentPlot
+			plot = DTCurrentPlot.DTCurrentPlot(path, **options)
+			data = plot.data
+			outputs += plot.plot_data()
+		else:
+			data = DTCurrentData.DTCurrentData(path, **options)
+		summary = summarize(data)
+		if not os.path.isdir(output):
+			os.makedirs(output)
+	except Exception as e:
+		print('Could not process {path}: {error}'.format(path=path, error=e))
+		return
+	
+	with open(output + SUMMARY_FILE, 'w') as fp:
+		json.dump(summary, fp, indent=1)
+	with open(output + MANIFEST_FILE, 'w') as fp:
+		json.dump({'inputs': inputs, 'outputs': outputs}, fp)
+	print('Processed ' + path)
+	return summary
+
+# fill dir or fill archive, but not the output dir written next to a fill archive
+def is_fill(path):
+	path = path.rstrip('/')
+	if DTCurrentData.is_archive(path):
+		return os.path.isfile(path)
+	return os.path.isdir(path) and not (path.endswith('.dtcurrent') and os.path.isfile(path[:-len('.dtcurrent')]))
+
+# process fill dirs and fill archives (list of paths or glob pattern) in a pool of workers processes, returns summaries
+def process_fills(paths, workers=1, plots=True, force=False, options={}):
+	if isinstance(paths, str):
+		paths = [paths]
+	expanded = []
+	for path in paths:
+		expanded += sorted(glob.glob(path)) or [path]
+	paths = [path for path in expanded if is_fill(path)]
+	
+	process = functools.partial(process_fill, plots=plots, force=force, options=options)
+	if workers > 1 and len(paths) > 1:
+		# plots are rendered with the non-interactive backend in worker processes
+		initializer = None
+		if plots:
+			import DTCurrentPlot
+			initializer = DTCurrentPlot.use_agg
+		pool = multiprocessing.Pool(min(workers, len(paths)), initializer=initializer)
+		try:
+			summaries = pool.map(process, paths, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		summaries = [process(path) for path in paths]
+	return [summary for summary in summaries if summary is not None]
+
+# write chambers of all summaries in one csv table
+def write_table(summaries, filename):
+	with open(filename, 'w') as fp:
+		writer = csv.writer(fp)
+		writer.writerow(COLUMNS)
+		for summary in summaries:
+			for row in summary['chambers']:
+				writer.writerow(['' if row[column] is None else row[column] for column in COLUMNS])
+	print('Saved ' + filename)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Process DT current fill dirs: summary table and plots of each fill')
+	parser.add_argument('paths', nargs='+', help='fill dirs, fill archives or glob patterns')
+	parser.add_argument('--workers', type=int, default=1, help='fills processed in parallel')
+	parser.add_argument('--no-plots', dest='plots', action='store_false')
+	parser.add_argument('--force', action='store_true', help='process also fills that have not changed')
+	parser.add_argument('--storage', default='masked')
+	parser.add_argument('--summary', help='csv file for the summary table of all fills')
+	args = parser.parse_args()
+	
+	if args.plots:
+		import matplotlib.pyplot as plt
+		plt.switch_backend('Agg')
+	
+	summaries = process_fills(args.paths, workers=args.workers, plots=args.plots, force=args.force, options={'storage': args.storage})
+	print('{fills} fills'.format(fills=len(summaries)))
+	if args.summary:
+		write_table(summaries, args.summary)
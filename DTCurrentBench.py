@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import shutil
+import datetime
+import platform
+import argparse
+import tempfile
+import timeit
+import numpy as np
+import DTCurrentData
+
+# writes synthetic fills and times loading, queries, fits and plots, results are saved as json
+# usage:
+# python DTCurrentBench.py --chambers 60 --rows 2000 --output bench.json
+# python DTCurrentBench.py --baseline bench.json --output bench_new.json
+
+# all chambers (wheel, station, sector)
+ALL_CHAMBERS = [(wheel, station, sector) for wheel in range(-2, 3) for station in range(1, 5) for sector in range(1, 13)]
+
+# chamber name used in file names and headers, eg. WM2_MB1_S07
+def chamber_name(wheel, station, sector):
+	return 'W{sign}{wheel}_MB{station}_S{sector:02d}'.format(sign='M' if wheel < 0 else ('0' if wheel == 0 else 'P'), wheel=abs(wheel), station=station, sector=sector)
+
+# write synthetic chamber files of one fill in the format read by DTCurrentData.load_file
+# chambers: number of chambers (chosen randomly) or list of (wheel, station, sector)
+# rows: rows per file, noise: gaussian noise of currents (uA), outliers: fraction of currents with spikes
+# clock_offset: chamber i logs (i * clock_offset) % 60 seconds later than the first one (staggered chamber clocks)
+def write_fill(path, fill=2984, chambers=60, rows=2000, noise=0.002, outliers=0.001, seed=0, clock_offset=0):
+	rng = np.random.RandomState(seed)
+	path = path.rstrip('/')+'/'
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	if isinstance(chambers, int):
+		chambers = [ALL_CHAMBERS[i] for i in sorted(rng.choice(len(ALL_CHAMBERS), min(chambers, len(ALL_CHAMBERS)), replace=False))]
+	
+	# luminosity: standby, background (ON with luminosity < 10), ramp to the peak and exponential decay
+	standby = max(rows // 50, 1)
+	bgrows = max(rows // 25, 2)
+	ramp = max(rows // 20, 2)
+	r = np.arange(rows)
+	luminosity = np.where(r < standby, 0.5, 0.)
+	luminosity = np.where((r >= standby) & (r < standby + bgrows), 1. + (r - standby) * 0.05, luminosity)
+	luminosity = np.where((r >= standby + bgrows) & (r < standby + bgrows + ramp), 5000. * (r - standby - bgrows + 1) / ramp, luminosity)
+	luminosity = np.where(r >= standby + bgrows + ramp, 5000. * np.exp(-(r - standby - bgrows - ramp) / (rows * 0.7)), luminosity)
+	states = np.where(r < standby, 'STANDBY', 'ON')
+	start = datetime.datetime(2012, 8, 18, 9, 35, 21)
+	
+	for i, (wheel, station, sector) in enumerate(chambers):
+		name = chamber_name(wheel, station, sector)
+		offset = (i * clock_offset) % 60
+		channels = (2 if station == 4 else 3) * 4 * 3# MB4 has only 2 superlayers
+		
+		# currents: background + slope * luminosity + noise, some values have spikes
+		slopes = rng.uniform(1e-5, 1e-4, channels)
+		background = rng.uniform(0., 0.01, channels)
+		currents = background + np.outer(luminosity, slopes) + rng.normal(0., noise, (rows, channels))
+		spikes = rng.uniform(size=currents.shape) < outliers
+		currents[spikes] += rng.uniform(0.1, 1., spikes.sum())
+		
+		columns = ''.join('   L{0}W0    L{0}W1   L{0}Cha'.format(layer) for layer in range(1, channels // 3 + 1))
+		line = '    {date}    {state:>8} {lumi:10.2f}' + ' {:7.3f}' * channels + '\n'
+		with open(path + name + '.txt', 'w') as fp:
+			fp.write('File for chamber {name} for Fill {fill} created at {date}\n'.format(name=name, fill=fill, date=start.strftime('%d-%m-%Y %H:%M:%S')))
+			fp.write('         Date     Time      State       Lumi' + columns + '\n')
+			for row in range(rows):
+				date = (start + datetime.timedelta(seconds=60 * row + offset)).strftime('%d-%m-%Y %H:%M:%S')
+				fp.write(line.format(*currents[row], date=date, state=states[row], lumi=luminosity[row]))
+	return chambers
+
+# peak memory allocated during one run of func (kB, python and numpy allocations traced by tracemalloc), None if not available
+# (memory-mapped files are not counted)
+def peak_memory(func):
+	try:
+		import tracemalloc
+	except ImportError:# python 2
+		return
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1] // 1024
+	finally:
+		tracemalloc.stop()
+
+# time func (best and mean of repeat runs) and its peak memory (one more run, tracing slows down the timed runs)
+# setup is called before each run and not timed
+def measure(name, func, repeat=3, setup=None):
+	times = []
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		start = timeit.default_timer()
+		func()
+		times.append(timeit.default_timer() - start)
+	if setup is not None:
+		setup()
+	result = {'name': name, 'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'repeat': repeat, 'peak_memory_kb': peak_memory(func)}
+	print('{name:<20} {seconds:10.4f} s  (mean {mean_seconds:.4f} s, peak memory {peak_memory_kb} kB)'.format(**result))
+	return result
+
+# run benchmarks on a synthetic fill (written to path or to a temporary dir), returns results dict
+def run(path=None, chambers=60, rows=2000, noise=0.002, outliers=0.001, seed=0, repeat=3, plots=True, plot_workers=1, options={}):
+	temporary = path is None
+	if temporary:
+		path = tempfile.mkdtemp(prefix='dtcurrent_bench_')
+	path = path.rstrip('/')+'/'
+	
+	try:
+		start = timeit.default_timer()
+		written = write_fill(path, chambers=chambers, rows=rows, noise=noise, outliers=outliers, seed=seed)
+		print('Wrote {files} files with {rows} rows in {seconds:.2f} s'.format(files=len(written), rows=rows, seconds=timeit.default_timer() - start))
+		
+		# fresh DTCurrentData for each load (loading into loaded data only inserts into its arrays)
+		results = []
+		results.append(measure('load_path', lambda: DTCurrentData.DTCurrentData(**options).load_path(path, cache=False), repeat=repeat))
+		data = DTCurrentData.DTCurrentData(**options)
+		data.load_path(path)# writes cache
+		results.append(measure('load_path_cached', lambda: DTCurrentData.DTCurrentData(**options).load_path(path), repeat=repeat))
+		
+		# queries without memoized results
+		wheel, station, sector = written[0]
+		def get():
+			data.get()
+			data.get(wheel=wheel, station=station, sector=sector, superlayer=1, layer=1, wire='wire0')
+		results.append(measure('get', get, repeat=repeat, setup=data.memo.clear))
+		results.append(measure('slope', lambda: data.slope(wheel=wheel, station=station, sector=sector), repeat=repeat, setup=data.memo.clear))
+		results.append(measure('slope_vs_sector', data.slope_vs_sector, repeat=repeat, setup=data.memo.clear))
+		results.append(measure('maxcurrent_vs_sector', data.maxcurrent_vs_sector, repeat=repeat, setup=data.memo.clear))
+		
+		if plots:
+			import matplotlib.pyplot as plt
+			plt.switch_backend('Agg')
+			import DTCurrentPlot
+			plot = DTCurrentPlot.DTCurrentPlot(path)
+			results.append(measure('draw_slope_2d', plot.draw_slope_2d, repeat=repeat, setup=plot.data.memo.clear))
+			results.append(measure('plot_data', lambda: plot.plot_data(workers=plot_workers), repeat=1, setup=plot.data.memo.clear))
+	finally:
+		if temporary:
+			shutil.rmtree(path)
+	
+	return {
+		'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+		'platform': platform.platform(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'parameters': {'chambers': chambers, 'rows': rows, 'noise': noise, 'outliers': outliers, 'seed': seed, 'repeat': repeat, 'plot_workers': plot_workers, 'options': options},
+		'results': results,
+	}
+
+# returns True if aligned loading keeps one point for each row (and one point before and after the reference chamber for earlier and later clocks)
+# returns True if aligned loading keeps one point for each row (and the rows of later clocks after the last row of the reference chamber)
+# and gives the same slope as position matched (align=False) loading
+def check_alignment(path=None, chambers=25, rows=400, clock_offset=7):
+	temporary = path is None
+	if temporary:
+		path = tempfile.mkdtemp(prefix='dtcurrent_align_')
+	path = path.rstrip('/')+'/'
+	
+	try:
+		write_fill(path, chambers=chambers, rows=rows, noise=0., outliers=0., clock_offset=clock_offset)
+		aligned = DTCurrentData.DTCurrentData(path, cache=False)
+		matched = DTCurrentData.DTCurrentData(path, cache=False, align=False)
+	finally:
+		if temporary:
+			shutil.rmtree(path)
+	
+	rows_aligned = aligned.currents.shape[-1]
+	rows_matched = matched.currents.shape[-1]
+	slope_aligned = aligned.slope()
+	slope_matched = matched.slope()
+	ok = rows_matched <= rows_aligned <= rows_matched + 2 and abs(slope_aligned - slope_matched) <= 1e-3 * abs(slope_matched)
+	print('Alignment check {result}: {rows_aligned} rows, slope {slope_aligned:.6e} (align=False: {rows_matched} rows, slope {slope_matched:.6e})'.format(
+		result='passed' if ok else 'FAILED', rows_aligned=rows_aligned, rows_matched=rows_matched, slope_aligned=slope_aligned, slope_matched=slope_matched))
+	return ok
+
+# print time of each benchmark relative to baseline results
+def compare(baseline, results):
+	before = dict((result['name'], result) for result in baseline['results'])
+	for result in results['results']:
+		if result['name'] not in before:
+			continue
+		ratio = result['seconds'] / before[result['name']]['seconds'] if before[result['name']]['seconds'] else float('inf')
+		print('{name:<20} {before:10.4f} s -> {after:10.4f} s  x{ratio:.2f}'.format(name=result['name'], before=before[result['name']]['seconds'], after=result['seconds'], ratio=ratio))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='DTCurrent benchmarks on synthetic fills')
+	parser.add_argument('--path', help='dir for synthetic files (default: temporary dir)')
+	parser.add_argument('--chambers', type=int, default=60)
+	parser.add_argument('--rows', type=int, default=2000)
+	parser.add_argument('--noise', type=float, default=0.002)
+	parser.add_argument('--outliers', type=float, default=0.001)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--no-plots', dest='plots', action='store_false')
+	parser.add_argument('--plot-workers', type=int, default=1)
+	parser.add_argument('--storage', default='masked')
+	parser.add_argument('--output', default='dtcurrent_bench.json', help='json file for results')
+	parser.add_argument('--baseline', help='json file of earlier results to compare with')
+	parser.add_argument('--check-alignment', action='store_true', help='only check aligning of chambers with staggered clocks')
+	args = parser.parse_args()
+	
+	if args.check_alignment:
+		sys.exit(0 if check_alignment(path=args.path) else 1)
+	
+	results = run(path=args.path, chambers=args.chambers, rows=args.rows, noise=args.noise, outliers=args.outliers, seed=args.seed, repeat=args.repeat, plots=args.plots, plot_workers=args.plot_workers, options={'storage': args.storage})
+	with open(args.output, 'w') as fp:
+		json.dump(results, fp, indent=1)
+	print('Saved ' + args.output)
+	
+	if args.baseline:
+		with open(args.baseline) as fp:
+			compare(json.load(fp), results)
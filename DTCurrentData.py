@@ -1,13 +1,600 @@
 import re
 import time
+import gzip
+import bz2
+import tarfile
+import zipfile
+import calendar
 import datetime
+import os
+import json
+import warnings
+import collections
+import functools
+import timeit
+import multiprocessing
 import numpy as np
+from numpy.lib.format import open_memmap
 from os import walk
+try:
+	import lzma
+except ImportError:# python 2
+	lzma = None
 
+# cache dir name (inside data dir) and format version
+CACHE_DIR = '.dtcurrent_cache'
+CACHE_VERSION = 5
+
+# instruments are enabled by default if this environment variable is set (and not 0)
+INSTRUMENT_ENV = 'DTCURRENT_INSTRUMENT'
+
+# chamber file name (also gzip, bz2 or xz compressed), eg WM2_MB1_S07.txt or WM2_MB1_S07.txt.gz
+def is_chamber_file(filename):
+	return re.search("^W(M|0|P)([0-2])_MB([1-4])_S([0-9]{2})(L|)\.txt(\.gz|\.bz2|\.xz|)$", os.path.basename(filename)) is not None
+
+# tar (also compressed) or zip archive of a fill
+def is_archive(filename):
+	return re.search("\.(tar|tar\.gz|tgz|tar\.bz2|tar\.xz|zip)$", filename) is not None
+
+# dir for outputs of a fill (plots, batch summary): the data dir, or <archive name>.dtcurrent/ next to a fill archive
+def output_dir(path):
+	path = path.rstrip('/')
+	if is_archive(path) and os.path.isfile(path):
+		return path + '.dtcurrent/'
+	return path + '/'
+
+# chamber files in dir (in directory listing order), or the archive if path is a fill archive
+def data_files(path):
+	if is_archive(path.rstrip('/')) and os.path.isfile(path.rstrip('/')):
+		return [path.rstrip('/')]
+	path = path.rstrip('/')+'/'
+	_, _, files = next(walk(path))
+	filenames = []
+	for file in files:
+		if not is_chamber_file(file):# filename is not in the correct form: eg WM2_MB1_S07.txt
+			continue
+		filenames.append(path + file)
+	return filenames
+
+# open chamber file for binary reading, compressed files are decompressed while reading
+# fileobj: archive member (filename is the member name)
+def open_chamber(filename, fileobj=None):
+	if filename.endswith('.gz'):
+		return gzip.GzipFile(filename, 'rb', fileobj=fileobj)
+	if filename.endswith('.bz2'):
+		return bz2.BZ2File(filename if fileobj is None else fileobj)
+	if filename.endswith('.xz'):
+		if lzma is None:
+			print("xz files need the lzma module: {file}".format(file=filename))
+			return
+		return lzma.LZMAFile(filename if fileobj is None else fileobj)
+	return open(filename, 'rb') if fileobj is None else fileobj
+	
+# parse header of a chamber file, returns (fill, wheel, station, sector) or None
+def parse_header(line, filename=''):
+	# File for chamber WP2_MB1_S10 for Fill 2984 created at 18-08-2012 09:35:21
+	m = re.search("^File for chamber (.+?) for Fill ([0-9]+?) created at ([0-9\-]+?) ([0-9:]{8})", line)
+	if not m:
+		print("File header is in wrong format")
+		return
+	chamber, fill, _, _ = m.groups()
+	
+	# parse wheel, station and sector number from chamber name
+	chamber_p = re.search("^W(M|0|P)([0-2])_MB([1-4])_S([0-9]{2})(L|)$", chamber)
+	if not chamber_p:
+		print("Unknown chamber syntax {chamber} in file {file}".format(chamber=chamber, file=filename))
+		return
+	mp0, wheel_abs, station_str, sector_str, _ = chamber_p.groups()
+	wheel = int(wheel_abs) * (1 if mp0 == 'P' else -1)
+	station = int(station_str)
+	sector = int(sector_str)
+	return (fill, wheel, station, sector)
+	
+# convert date (dd-mm-YYYY) and time (HH:MM:SS) string arrays to epoch seconds
+def epoch_seconds(dates, times):
+	dates = np.asarray(dates, dtype='S10').view('S1').reshape((-1, 10))
+	times = np.asarray(times, dtype='S8').view('S1').reshape((-1, 8))
+	space = np.empty((len(dates), 1), dtype='S1')
+	space[:] = b' '
+	
+	# rearrange characters to ISO format YYYY-mm-dd HH:MM:SS
+	iso = np.hstack((dates[:, 6:10], dates[:, 2:3], dates[:, 3:5], dates[:, 5:6], dates[:, 0:2], space, times))
+	iso = np.ascontiguousarray(iso).view('S19').ravel()
+	return iso.astype('datetime64[s]').astype(np.int64)
+	
+# parse data rows (text after the header lines), returns (timestamps, luminosity, currents) of rows with state ON
+# timestamps are epoch seconds
+def parse_rows(text, columns, fast=True):
+	# data
+	#    18-08-2012 09:35:21    STANDBY       0.65  0.000   0.000   0.000  0.000
+	if fast:
+		# split all rows at once, fall back to line by line parsing if rows have different length
+		data = text.split()
+		if columns > 4 and len(data) % columns == 0:
+			data = np.array(data, dtype=object).reshape((-1, columns))
+			data = data[data[:, 2] == "ON"]# status is RAMPING or STANDBY
+			timestamps = epoch_seconds(data[:, 0], data[:, 1])
+			luminosity = data[:, 3].astype(float)
+			currents = data[:, 4:].astype(float)
+			return (timestamps, luminosity, currents)
+	
+	timestamps = []
+	luminosity = []
+	currents = []
+	for line in text.splitlines():
+		data = line.split()
+		if not (data[2] == "ON"):# status is RAMPING or STANDBY
+			continue
+		timestamps.append(calendar.timegm(datetime.datetime.strptime(data[0]+' '+data[1], "%d-%m-%Y %H:%M:%S").timetuple()))
+		luminosity.append(float(data[3]))
+		currents.append([float(i) for i in data[4:]])
+	
+	# use numpy arrays (easier to manipulate)
+	return (np.array(timestamps, dtype=np.int64), np.array(luminosity), np.array(currents))
+	
+# parse one txt file, returns (fill, wheel, station, sector, timestamps, luminosity, currents) or None
+# only rows with state ON are returned, timestamps are epoch seconds
+def parse_file(filename, fast=True, fileobj=None):
+	fp = open_chamber(filename, fileobj)
+	if fp is None:
+		return
+	with fp:
+		header = parse_header(fp.readline().decode('latin-1'), filename)
+		if header is None:
+			return
+		
+		# tabs info
+		#          Date     Time      State       Lumi   L1W0    L1W1   L1Cha   L2W0
+		columns = len(fp.readline().split())
+		
+		return header + parse_rows(fp.read().decode('latin-1'), columns, fast=fast)
+
+# parse one txt file and split currents to background and luminosity dependent part
+# returns (fill, wheel, station, sector, luminosity, currents, background, timestamps) or None
+def read_chamber(filename, fast=True, fileobj=None):
+	return chamber_data(parse_file(filename, fast=fast, fileobj=fileobj))
+
+# chamber data from parse_file result (None if the file was not parsed), background is calculated and ramp-up rows are left out
+def chamber_data(parsed):
+	if parsed is None:
+		return
+	fill, wheel, station, sector, timestamps, luminosity, currents = parsed
+	
+	# calculate background current (bg=mean values where state=ON and luminosity<10 at the beginning)
+	bgrows = np.argmax(luminosity > 10)
+	background = currents[: bgrows].mean(0)
+	
+	# remove rows with small luminosity from the beginning (during ramping)
+	imax = np.argmax(luminosity)
+	currents = currents[imax:]
+	luminosity = luminosity[imax:]
+	timestamps = timestamps[imax:]
+	
+	return (fill, wheel, station, sector, luminosity, currents, background, timestamps)
+
+# errors of damaged archives
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, IOError, OSError, EOFError)
+
+# chamber files of a tar or zip archive in archive order, yields (name, file object)
+# members are decompressed while reading (nothing is extracted)
+def archive_members(filename):
+	if filename.endswith('.zip'):
+		with zipfile.ZipFile(filename) as archive:
+			for info in archive.infolist():
+				if is_chamber_file(info.filename):
+					yield (filename + '/' + info.filename, archive.open(info))
+	else:
+		# stream mode: compressed tar is read once from the beginning
+		with tarfile.open(filename, 'r|*') as archive:
+			for member in archive:
+				if member.isfile() and is_chamber_file(member.name):
+					yield (filename + '/' + member.name, archive.extractfile(member))
+
+# read chamber file or all chamber files of an archive
+# returns (list of read_chamber results, number of files read, number of rows parsed before ramp-up rows are left out)
+def parse_chambers(filename, fast=True):
+	if not is_archive(filename):
+		parsed = parse_file(filename, fast=fast)
+		return ([chamber_data(parsed)], 1, 0 if parsed is None else len(parsed[4]))
+	
+	chambers = []
+	rows = 0
+	try:
+		for name, fp in archive_members(filename):
+			parsed = parse_file(name, fast=fast, fileobj=fp)
+			chambers.append(chamber_data(parsed))
+			rows += 0 if parsed is None else len(parsed[4])
+	except ARCHIVE_ERRORS as e:
+		print('Could not read archive {file}: {error}'.format(file=filename, error=e))
+		return ([], len(chambers), rows)
+	return (chambers, len(chambers), rows)
+
+# read chamber file or all chamber files of an archive, returns list of read_chamber results
+def read_chambers(filename, fast=True):
+	return parse_chambers(filename, fast=fast)[0]
+
+# parse header of a chamber file or of the first chamber file of an archive (data rows are not read)
+def read_header(filename, fileobj=None):
+	if fileobj is None and is_archive(filename):
+		try:
+			for name, fp in archive_members(filename):
+				return read_header(name, fp)
+		except ARCHIVE_ERRORS as e:
+			print('Could not read archive {file}: {error}'.format(file=filename, error=e))
+		return
+	fp = open_chamber(filename, fileobj)
+	if fp is None:
+		return
+	with fp:
+		return parse_header(fp.readline().decode('latin-1'), filename)
+
+# list of data file names, sizes and modification times used to validate the cache
+def cache_manifest(filenames):
+	files = []
+	for filename in sorted(filenames):
+		stat = os.stat(filename)
+		files.append([os.path.basename(filename), stat.st_size, stat.st_mtime])
+	return {'version': CACHE_VERSION, 'files': files}
+
+# shared time axis of chambers: timestamps of the chamber with the most rows (reference grid) and timestamps of other chambers
+# (longest first) that are more than tolerance seconds away from every point of the axis and can not be interpolated on it
+# (before or after the axis, or inside a gap longer than max_gap seconds), rows are put on the nearest point at most tolerance seconds away
+# returns (axis timestamps, axis luminosity (mean of chamber luminosities at each point), axis row of each row of each chamber (-1: not on the axis))
+def time_axis(timestamps, luminosity, tolerance=10, max_gap=120):
+	order = sorted(range(len(timestamps)), key=lambda i: -len(timestamps[i]))
+	axis = np.unique(np.asarray(timestamps[order[0]], dtype=np.int64))
+	for i in order[1:]:
+		t = np.asarray(timestamps[i], dtype=np.int64)
+		if len(axis) and len(t):
+			after = np.searchsorted(axis, t)
+			inside = (after > 0) & (after < len(axis))
+			span = axis[np.minimum(after, len(axis) - 1)] - axis[np.maximum(after - 1, 0)]
+			t = t[(nearest_rows(axis, t)[1] > tolerance) & ~(inside & (span <= max_gap))]
+		axis = np.union1d(axis, t)
+	
+	rows = [axis_rows(axis, np.asarray(t, dtype=np.int64), tolerance) for t in timestamps]
+	points = np.concatenate(rows)
+	keep = points >= 0
+	counts = np.bincount(points[keep], minlength=len(axis))
+	axis_luminosity = np.bincount(points[keep], weights=np.concatenate(luminosity)[keep], minlength=len(axis)) / np.maximum(counts, 1)
+	return (axis, axis_luminosity, rows)
+
+# nearest row of sorted (not empty) axis for each timestamp, returns (rows, distances in seconds)
+def nearest_rows(axis, timestamps):
+	after = np.minimum(np.searchsorted(axis, timestamps), len(axis) - 1)
+	before = np.maximum(after - 1, 0)
+	rows = np.where(np.abs(axis[after] - timestamps) < np.abs(axis[before] - timestamps), after, before)
+	return (rows, np.abs(axis[rows] - timestamps))
+
+# nearest axis row of each timestamp, -1 if the nearest axis point is more than tolerance seconds away
+# (or if another timestamp is closer to the same point, one row of a chamber for each point)
+def axis_rows(axis, timestamps, tolerance=10):
+	if not len(axis):
+		return -np.ones(len(timestamps), dtype=int)
+	rows, distance = nearest_rows(axis, timestamps)
+	rows = np.where(distance <= tolerance, rows, -1)
+	
+	valid = np.flatnonzero(rows >= 0)
+	order = valid[np.lexsort((distance[valid], rows[valid]))]
+	duplicate = np.zeros(len(order), dtype=bool)
+	duplicate[1:] = rows[order[1:]] == rows[order[:-1]]
+	rows[order[duplicate]] = -1
+	return rows
+
+# currents of one chamber on the time axis (rows: axis row of each chamber row, -1 if the row is not on the axis)
+# axis points without a chamber row are interpolated from the rows before and after them (nearest row at the ends)
+# if the gap is at most max_gap seconds, otherwise they are NaN
+def align_currents(axis, rows, timestamps, currents, max_gap=120):
+	aligned = np.full((len(axis), currents.shape[1]), np.nan, dtype=currents.dtype)
+	if not len(rows):
+		return aligned
+	keep = rows >= 0
+	aligned[rows[keep]] = currents[keep]
+	missing = np.ones(len(axis), dtype=bool)
+	missing[rows[keep]] = False
+	missing = np.flatnonzero(missing)
+	
+	t = axis[missing]
+	after = np.searchsorted(timestamps, t)
+	before = np.maximum(after - 1, 0)
+	after = np.minimum(after, len(timestamps) - 1)
+	span = timestamps[after] - timestamps[before]
+	gap = np.where(span > 0, span, np.abs(t - timestamps[after]))
+	weight = np.where(span > 0, (t - timestamps[before]) / np.maximum(span, 1.), 0.)[:, np.newaxis]
+	fill = gap <= max_gap
+	aligned[missing[fill]] = (currents[before] * (1 - weight) + currents[after] * weight)[fill]
+	return aligned
+
+# points used in the fit of each series along the last (rows) axis of currents (outliers=False: only values above 0)
+def fit_mask(currents, outliers=True):
+	data = np.ma.getdata(currents)
+	
+	# fit only values above 0 (useful in cathode plots, where current vs lumi goes like 0000001234)
+	mask1 = data > 0
+	if not outliers:
+		return mask1 & ~np.ma.getmaskarray(currents)
+	
+	# remove points that differs more than 0.02*3 from nearby values mean (outliers)
+	# the point before the last one is always kept, the last one is checked with its previous point mean
+	mask2 = np.ones(data.shape, dtype=bool)
+	if data.shape[-1] > 2:
+		outliers = np.ma.getdata((currents[..., 1:-1]*2 - currents[..., :-2] - currents[..., 2:]) < 0.02 * 3)
+		mask2[..., 1:-2] = outliers[..., :-1]
+		mask2[..., -1] = outliers[..., -1]
+	return mask1 & mask2 & ~np.ma.getmaskarray(currents)
+	
+# centered sums of the fit for each series along the last (rows) axis of currents (mask = points used, default fit_mask)
+# returns (points, xmean, ymean, sxx, sxy), sums of several fills can be combined with merge_sums
+def line_sums(luminosity, currents, mask=None):
+	if mask is None:
+		mask = fit_mask(currents)
+	data = np.ma.getdata(currents).astype(float)
+	
+	points = mask.sum(-1)
+	count = np.maximum(points, 1)
+	xmean = np.where(mask, luminosity, 0).sum(-1) / count
+	ymean = np.where(mask, data, 0).sum(-1) / count
+	dx = np.where(mask, luminosity - xmean[..., np.newaxis], 0)
+	dy = np.where(mask, data - ymean[..., np.newaxis], 0)
+	return (points, xmean, ymean, (dx * dx).sum(-1), (dx * dy).sum(-1))
+	
+# combine centered sums of two data sets
+def merge_sums(a, b):
+	points_a, xmean_a, ymean_a, sxx_a, sxy_a = a
+	points_b, xmean_b, ymean_b, sxx_b, sxy_b = b
+	points = points_a + points_b
+	count = np.maximum(points, 1)
+	xmean = (points_a * xmean_a + points_b * xmean_b) / count
+	ymean = (points_a * ymean_a + points_b * ymean_b) / count
+	sxx = sxx_a + sxx_b + points_a * (xmean_a - xmean)**2 + points_b * (xmean_b - xmean)**2
+	sxy = sxy_a + sxy_b + points_a * (xmean_a - xmean) * (ymean_a - ymean) + points_b * (xmean_b - xmean) * (ymean_b - ymean)
+	return (points, xmean, ymean, sxx, sxy)
+	
+# slopes and intercepts from centered sums, both are 0 if there are less than 10 points or luminosity is constant
+def sums_to_lines(sums):
+	points, xmean, ymean, sxx, sxy = sums
+	ok = (points >= 10) & (sxx > 0)
+	slopes = np.where(ok, sxy / np.where(ok, sxx, 1), 0.)
+	intercepts = np.where(ok, ymean - slopes * xmean, 0.)
+	return (slopes, intercepts)
+	
+# fit current = slope * luminosity + intercept for each series along the last (rows) axis of currents
+# returns (slopes, intercepts), both are 0 if less than 10 points are left after masking
+def fit_lines(luminosity, currents):
+	return sums_to_lines(line_sums(luminosity, currents))
+
+# luminosity binned profile of each series along the last (rows) axis of currents, bins of equal width
+# returns (centers, mean, spread, count) of bins with rows: mean, standard deviation and number of currents in each bin
+def profile(luminosity, currents, bins=100):
+	luminosity = np.asarray(luminosity)
+	data = np.ma.getdata(currents).astype(float)
+	valid = ~np.ma.getmaskarray(currents) & ~np.isnan(data)
+	data = np.where(valid, data, 0.)
+	
+	# bin of each row, rows are sorted by bin and summed over each bin
+	low, high = luminosity.min(), luminosity.max()
+	width = (high - low) / bins if high > low else 1.
+	index = np.minimum(((luminosity - low) / width).astype(int), bins - 1)
+	order = np.argsort(index, kind='mergesort')
+	used, starts = np.unique(index[order], return_index=True)
+	sum_bins = lambda values: np.add.reduceat(values[..., order], starts, axis=-1)
+	
+	count = sum_bins(valid.astype(int))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean = sum_bins(data) / count
+		deviation = np.where(valid, data - mean[..., np.searchsorted(used, index)], 0.)
+		spread = np.sqrt(sum_bins(deviation * deviation) / count)
+	return (low + (used + 0.5) * width, mean, spread, count)
+	
+# robust fit current = slope * luminosity + intercept for each series along the last (rows) axis of currents
+# iteratively reweighted least squares with Huber weights: residuals above k * scale are down-weighted,
+# scale is the median absolute residual of the first (unweighted) fit, all values above 0 are used
+# stops after iterations or when no slope changes more than tolerance (relative)
+# returns (slopes, intercepts), both are 0 if less than 10 points are left after masking
+def robust_lines(luminosity, currents, iterations=20, tolerance=1e-6, k=1.345):
+	mask = fit_mask(currents, outliers=False)
+	points = mask.sum(-1)
+	slopes = np.zeros(points.shape)
+	intercepts = np.zeros(points.shape)
+	
+	# fit only series with enough points, luminosity is centered
+	fitted = points >= 10
+	if not fitted.any():
+		return (slopes, intercepts)
+	mask = mask[fitted]
+	x0 = np.mean(luminosity)
+	x = np.asarray(luminosity, dtype=float) - x0
+	y = np.where(mask, np.ma.getdata(currents)[fitted], 0.).astype(float)
+	weights = mask.astype(float)
+	
+	slope = None
+	limit = None
+	for _ in range(iterations):
+		# weighted fit
+		sw = weights.sum(-1)
+		swx = weights.dot(x)
+		wy = weights * y
+		swy = wy.sum(-1)
+		sxx = weights.dot(x * x) - swx * swx / sw
+		sxy = wy.dot(x) - swx * swy / sw
+		new = np.where(sxx > 0, sxy / np.where(sxx > 0, sxx, 1), 0.)
+		intercept = (swy - new * swx) / sw
+		
+		converged = slope is not None and np.all(np.abs(new - slope) <= tolerance * np.abs(new))
+		slope = new
+		if converged:
+			break
+		
+		# Huber weights
+		residuals = np.abs(y - intercept[:, np.newaxis] - slope[:, np.newaxis] * x)
+		if limit is None:
+			ordered = np.sort(np.where(mask, residuals, np.inf), axis=-1)
+			scale = 1.4826 * ordered[np.arange(len(ordered)), (points[fitted] - 1) // 2]
+			limit = np.where(scale > 0, k * scale, np.inf)[:, np.newaxis]
+		with np.errstate(divide='ignore', invalid='ignore'):
+			weights = np.where(residuals > limit, limit / residuals, 1.) * mask
+	
+	slopes[fitted] = slope
+	intercepts[fitted] = intercept - slope * x0
+	return (slopes, intercepts)
+	
+# unique number for each (wheel, station, sector) row of chambers array, ordered like chambers
+def chamber_ids(chambers):
+	chambers = np.asarray(chambers).reshape((-1, 3))
+	return ((chambers[:, 0]+2)*4 + chambers[:, 1]-1)*12 + chambers[:, 2]-1
+
+# mean over axis ignoring missing values (masked or NaN)
+def nanmean(c, axis):
+	if isinstance(c, np.ma.MaskedArray):
+		return c.mean(axis)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)# mean of all NaN values
+		return np.nanmean(c, axis)
+		
+# maximum value ignoring missing values (masked or NaN)
+def nanmax(c, axis=None):
+	if isinstance(c, np.ma.MaskedArray):
+		return c.max(axis)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)# max of all NaN values
+		return np.nanmax(c, axis)
+
+# least recently used memo for query results with hit and miss counters
+class QueryMemo(object):
+	def __init__(self, size=256):
+		self.size = size
+		self.items = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		
+	# return stored value (and mark it as recently used) or None
+	def lookup(self, key):
+		if key not in self.items:
+			self.misses += 1
+			return
+		self.hits += 1
+		value = self.items.pop(key)
+		self.items[key] = value
+		return value
+		
+	# store value, drop least recently used values if memo is full
+	def store(self, key, value):
+		if self.size <= 0:
+			return
+		self.items.pop(key, None)
+		self.items[key] = value
+		while len(self.items) > self.size:
+			self.items.popitem(last=False)
+			
+	def clear(self):
+		self.items.clear()
+		
+	# hit and miss statistics
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'items': len(self.items), 'size': self.size}
+
+# read only views of arrays in a memoized value (results are shared by later calls, changing them raises ValueError)
+def read_only(value):
+	if isinstance(value, tuple):
+		return tuple(read_only(v) for v in value)
+	if isinstance(value, list):
+		return [read_only(v) for v in value]
+	if isinstance(value, np.ma.MaskedArray) and value is not np.ma.masked:
+		mask = value.mask if value.mask is np.ma.nomask else read_only(value.mask)
+		return np.ma.array(read_only(value.data), mask=mask, copy=False)
+	if isinstance(value, np.ndarray):
+		value = value.view()
+		value.flags.writeable = False
+	return value
+
+# wall time of a stage, used as: with instruments.timer('parse'): ...
+class StageTimer(object):
+	def __init__(self, instruments, stage):
+		self.instruments = instruments
+		self.stage = stage
+		
+	def __enter__(self):
+		self.start = timeit.default_timer()
+		
+	def __exit__(self, *exc):
+		self.instruments.add_time(self.stage, timeit.default_timer() - self.start)
+		
+# timer of disabled instruments
+class NullTimer(object):
+	def __enter__(self):
+		pass
+		
+	def __exit__(self, *exc):
+		pass
+		
+NULL_TIMER = NullTimer()
+
+# wall time and calls of each stage and counters, disabled instruments record nothing
+# stage times are inclusive (eg. get includes reduce and fit)
+class Instruments(object):
+	def __init__(self, enabled=None):
+		if enabled is None:
+			enabled = os.environ.get(INSTRUMENT_ENV, '0') not in ('', '0')
+		self.enabled = enabled
+		self.reset()
+		
+	def reset(self):
+		self.times = collections.OrderedDict()
+		self.calls = collections.OrderedDict()
+		self.counts = collections.OrderedDict()
+		
+	# context manager measuring wall time of a stage
+	def timer(self, stage):
+		if not self.enabled:
+			return NULL_TIMER
+		return StageTimer(self, stage)
+		
+	# call func and measure its wall time as a stage
+	def call(self, stage, func, *args, **kwargs):
+		if not self.enabled:
+			return func(*args, **kwargs)
+		with StageTimer(self, stage):
+			return func(*args, **kwargs)
+		
+	def add_time(self, stage, seconds):
+		self.times[stage] = self.times.get(stage, 0.) + seconds
+		self.calls[stage] = self.calls.get(stage, 0) + 1
+		
+	# add n to counter
+	def count(self, name, n=1):
+		if self.enabled:
+			self.counts[name] = self.counts.get(name, 0) + n
+			
+	# summary table of stages and counters
+	def report(self):
+		lines = ['{:<24} {:>8} {:>12} {:>12}'.format('stage', 'calls', 'total s', 'mean ms')]
+		for stage in self.times:
+			lines.append('{:<24} {:>8d} {:>12.4f} {:>12.3f}'.format(stage, self.calls[stage], self.times[stage], self.times[stage] / self.calls[stage] * 1e3))
+		if self.counts:
+			lines.append('{:<24} {:>8}'.format('counter', 'value'))
+			for name in self.counts:
+				lines.append('{:<24} {:>8d}'.format(name, self.counts[name]))
+		return '\n'.join(lines)
+		
+	# run one call with cProfile (works also when instruments are disabled), prints 25 functions with the largest cumulative time and returns result
+	def profile(self, func, *args, **kwargs):
+		import cProfile
+		import pstats
+		profiler = cProfile.Profile()
+		result = profiler.runcall(func, *args, **kwargs)
+		pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+		return result
+		
 # loads CMS DT current log files and returns average currents
 
 class DTCurrentData(object):
-	def __init__(self, path=''):
+	def __init__(self, path='', fast=True, workers=1, cache=True, memo_size=256, storage='masked', dtype=float, instrument=None, chunk_rows=None, robust=False, align=True, align_tolerance=10, max_gap=120):
+		# memoized query results (least recently used are dropped when memo_size is reached)
+		self.memo = QueryMemo(memo_size)
+		
+		# stage timers and counters (None = enabled if DTCURRENT_INSTRUMENT environment variable is set)
+		self.instruments = Instruments(instrument)
+		
 		# initial values filled during loading
 		self.loaded = False
 		self.path = ""
@@ -16,9 +603,50 @@ class DTCurrentData(object):
 		self.timestamps = []
 		self.luminosity = []
 		self.fill = ""
+		self._subtracted = None
+		
+		# sparse storage: (wheel, station, sector) of each block, block number for each chamber (-1 = not loaded)
+		self.chambers = np.zeros((0, 3), dtype=int)
+		self.index = -np.ones((5, 4, 12), dtype=int)
+		self._pending = []
 		self.currents = None
 		self.background = None
 		
+		# (first row, background) of appended fills, their rows are subtracted with their own background
+		self.appended = []
+		
+		# use vectorized file parser (False = line by line parser)
+		self.fast = fast
+		
+		# number of processes used for parsing files
+		self.workers = workers
+		
+		# store parsed arrays in the data dir and reuse them if files have not changed
+		self.cache = cache
+		
+		# currents storage: 'masked' (numpy masked arrays), 'nan' (plain arrays, NaN for missing channels)
+		# or 'sparse' (one block for each loaded chamber, NaN for missing channels)
+		if storage not in ('masked', 'nan', 'sparse'):
+			raise ValueError("storage value should be masked|nan|sparse")
+		self.storage = storage
+		self.dtype = np.dtype(dtype)
+		
+		# fit lines with robust_lines (Huber weights) instead of fit_lines (fixed outlier threshold)
+		self.robust = robust
+		
+		# align chambers on a shared time axis (False = rows are matched by position, luminosity of the first file is used)
+		# timestamps less than align_tolerance seconds apart are one point, gaps up to max_gap seconds are interpolated
+		self.align = align
+		self.align_tolerance = align_tolerance
+		self.max_gap = max_gap
+		
+		# out-of-core mode: arrays are memory-mapped files in the cache dir and queries read chunk_rows rows at a time
+		# (None = arrays in memory), not available with sparse storage (blocks are merged in memory)
+		if chunk_rows and storage == 'sparse':
+			raise ValueError("chunk_rows can not be used with sparse storage (use masked or nan)")
+		self.chunk_rows = chunk_rows
+		self.disk_arrays = {}
+		
 		# valid filter options
 		self.valid_wheels = np.array([-2,-1,0,1,2])
 		self.valid_stations = np.array([1,2,3,4])
@@ -26,106 +654,216 @@ class DTCurrentData(object):
 		self.valid_superlayers = np.array([1,2,3])
 		self.valid_layers = np.array([1,2,3,4])
 		self.valid_wires = ["wire0", "wire1", "cathode"]
+		self.keywords = ['wheel', 'station', 'sector', 'superlayer', 'layer', 'wire']
 		
 		# autoload data if path is specified
 		if path:
 			self.load_path(path)
 	
-	# look for files in dir
-	def load_path(self, path):
+	# look for files in dir (or read fill archive), files are parsed in a process pool if workers > 1
+	def load_path(self, path, workers=None, cache=None):
+		if workers is None:
+			workers = self.workers
+		if cache is None:
+			cache = self.cache
 		self.path = path.rstrip('/')+'/'
 		
-		_, _, files = walk(self.path).next()
-		files_nr = 0
-		for file in files:
-			m = re.search("^W(M|0|P)([0-2])_MB([1-4])_S([0-9]{2})(L|)\.txt$", file)
-			if not m:# filename is not in the correct form: eg WM2_MB1_S07.txt
-				continue
-			self.load_file(self.path + file)
-			files_nr += 1
+		filenames = data_files(self.path)
+		files_nr = len(filenames)
+		
+		# use cached arrays if data files have not changed since last load
+		manifest = dict(cache_manifest(filenames), storage=self.storage, dtype=self.dtype.str, align=[self.align_tolerance, self.max_gap] if self.align else False)
+		if cache and self.instruments.call('cache load', self.load_cache, manifest):
+			print('Loaded {files} files from cache in path {path}'.format(files=files_nr, path=path))
+			return
+		
+		if self.align and self.chunk_rows:
+			# out-of-core mode: time axis is built in a first pass keeping only timestamps and luminosity,
+			# then files are parsed again and inserted one at a time (memory is not used for all parsed files)
+			timestamps = []
+			luminosity = []
+			for filename in filenames:
+				for chamber in self.parse(filename):
+					if chamber is not None:
+						timestamps.append(chamber[7])
+						luminosity.append(chamber[4])
+			if timestamps:
+				with self.instruments.timer('align'):
+					axis, axis_luminosity, _ = time_axis(timestamps, luminosity, self.align_tolerance, self.max_gap)
+				for filename in filenames:
+					self.insert_chambers(self.parse(filename), (axis, axis_luminosity))
+		elif workers > 1 and files_nr > 1 and not self.chunk_rows:
+			# parse files in parallel, insert into global arrays in the same order as serial loading
+			pool = multiprocessing.Pool(min(workers, files_nr))
+			try:
+				parsed = self.instruments.call('parse', pool.map, functools.partial(parse_chambers, fast=self.fast), filenames)
+			finally:
+				pool.close()
+				pool.join()
+			self.insert_chambers([chamber for result in parsed for chamber in self.count_parsed(result)])
+		elif self.align:
+			# time axis is built from all chambers before inserting
+			chambers = []
+			for filename in filenames:
+				chambers += self.parse(filename)
+			self.insert_chambers(chambers)
+		else:
+			for filename in filenames:
+				self.load_file(filename)
+		if self.currents is None:
+			print('No chamber data in path {path}'.format(path=path))
+			return
 		
 		print('Loaded {files} files from path {path}'.format(files=files_nr, path=path))
 		self.loaded = True
+		self.instruments.call('find locations', self.find_locations)
+		
+		if cache or self.chunk_rows:
+			self.instruments.call('cache save', self.save_cache, manifest)
+		
+		# out-of-core mode: use memory-mapped arrays instead of arrays built in memory (sparse storage)
+		if self.chunk_rows:
+			self.load_cache(manifest)
+			
+	# check which wheels, stations and sectors files have been found
+	def find_locations(self):
+		for name in ['wheel', 'station', 'sector']:
+			valid, values = self.aggregate(stat='max', by=(name,))
+			with np.errstate(invalid='ignore'):
+				setattr(self, name + 's', valid[0][values > 0])
+			
+	# cache dir inside the data dir, or .dtcurrent_cache/<archive name>/ next to a fill archive
+	def cache_path(self):
+		path = self.path.rstrip('/')
+		if is_archive(path) and os.path.isfile(path):
+			return os.path.join(os.path.dirname(path), CACHE_DIR, os.path.basename(path)) + '/'
+		return self.path + CACHE_DIR + '/'
+		
+	# save loaded arrays in the cache dir next to the data files
+	def save_cache(self, manifest):
+		if self.currents is None:
+			return
+		cache_path = self.cache_path()
+		try:
+			if not os.path.isdir(cache_path):
+				os.makedirs(cache_path)
 			
-		# check which wheels, stations and sectors files have been found
-		wheels = []
-		for wheel in self.valid_wheels:
-			_r = self.get(wheel=wheel)
-			if _r is not None and _r.max() > 0:
-				wheels.append(wheel)
-		self.wheels = np.array(wheels)
-				
-		stations = []
-		for station in self.valid_stations:
-			_r = self.get(station=station)
-			if _r is not None and _r.max() > 0:
-				stations.append(station)
-		self.stations = np.array(stations)
-				
-		sectors = []
-		for sector in self.valid_sectors:
-			_r = self.get(sector=sector)
-			if _r is not None and _r.max() > 0:
-				sectors.append(sector)
-		self.sectors = np.array(sectors)
+			# remove old manifest first, cache is valid only after new manifest is written
+			if os.path.exists(cache_path + 'manifest.json'):
+				os.remove(cache_path + 'manifest.json')
 			
-	# load one txt file
-	def load_file(self, filename):
-		dates = []
-		times = []
-		timestamps = []
-		luminosity = []
-		currents = []
-		
-		# read file contents
-		with open(filename) as fp:
-			for line_nr, line in enumerate(fp):
-				if line_nr == 0:
-					# file header
-					# File for chamber WP2_MB1_S10 for Fill 2984 created at 18-08-2012 09:35:21
-					m = re.search("^File for chamber (.+?) for Fill ([0-9]+?) created at ([0-9\-]+?) ([0-9:]{8})", line)
-					if not m:
-						print("File header is in wrong format")
-						return
-					chamber, self.fill, _, _ = m.groups()
-					
-					# parse wheel, station and sector number from chamber name
-					chamber_p = re.search("^W(M|0|P)([0-2])_MB([1-4])_S([0-9]{2})(L|)$", chamber)
-					if not chamber_p:
-						print("Unknown chamber syntax {chamber} in file {file}".format(chamber=chamber, file=filename))
-						return
-					mp0, wheel_abs, station_str, sector_str, _ = chamber_p.groups()
-					wheel = int(wheel_abs) * (1 if mp0 is 'P' else -1)
-					station = int(station_str)
-					sector = int(sector_str)
-				elif line_nr == 1:
-					# tabs info
-					#          Date     Time      State       Lumi   L1W0    L1W1   L1Cha   L2W0
-					continue
+			# arrays are written to temporary files and renamed, other processes keep using their memory-mapped old files
+			def save(name, array):
+				if name in self.disk_arrays:# out-of-core arrays are already in the cache dir
+					self.disk_arrays[name].flush()
 				else:
-					# data
-					#    18-08-2012 09:35:21    STANDBY       0.65  0.000   0.000   0.000  0.000
-					data = line.split()
-					if not (data[2] == "ON"):# status is RAMPING or STANDBY
-						continue
-					dates.append(data[0])
-					times.append(data[1])
-					timestamps.append(datetime.datetime.strptime(data[0]+' '+data[1], "%d-%m-%Y %H:%M:%S"))
-					luminosity.append(float(data[3]))
-					currents.append([float(i) for i in data[4:]])
-		
-		# use numpy arrays (easier to manipulate)
-		luminosity = np.array(luminosity)
-		currents = np.array(currents)
-		
-		# calculate background current (bg=mean values where state=ON and luminosity<10 at the beginning)
-		bgrows = np.argmax(luminosity > 10)
-		background = currents[: bgrows].mean(0)
-		
-		# remove rows with small luminosity from the beginning (during ramping)
-		imax = np.argmax(luminosity)
-		currents = currents[imax:]
-		luminosity = luminosity[imax:]
+					with open(cache_path + name + '.tmp', 'wb') as fp:
+						np.save(fp, array)
+					os.rename(cache_path + name + '.tmp', cache_path + name)
+			save('currents.npy', np.ma.getdata(self.currents))
+			save('background.npy', np.ma.getdata(self.background))
+			if self.storage == 'masked':
+				save('currents_mask.npy', np.ma.getmaskarray(self.currents))
+				save('background_mask.npy', np.ma.getmaskarray(self.background))
+			save('luminosity.npy', self.luminosity)
+			save('timestamps.npy', np.asarray(self.timestamps, dtype=np.int64))
+			if self.storage == 'sparse':
+				save('chambers.npy', self.chambers)
+			
+			info = dict(manifest, fill=self.fill, wheels=self.wheels.tolist(), stations=self.stations.tolist(), sectors=self.sectors.tolist())
+			with open(cache_path + 'manifest.json.tmp', 'w') as fp:
+				json.dump(info, fp)
+			os.rename(cache_path + 'manifest.json.tmp', cache_path + 'manifest.json')
+		except (IOError, OSError) as e:
+			print('Could not save cache in {path}: {error}'.format(path=cache_path, error=e))
+		
+	# load arrays from the cache dir (memory-mapped copy-on-write, changes like load_file stay in memory), returns False if cache is missing or outdated
+	def load_cache(self, manifest):
+		cache_path = self.cache_path()
+		try:
+			with open(cache_path + 'manifest.json') as fp:
+				info = json.load(fp)
+		except (IOError, OSError, ValueError):
+			return False
+		for key in manifest:
+			if info.get(key) != manifest[key]:
+				return False
+		
+		try:
+			load = lambda name: np.load(cache_path + name, mmap_mode='c')
+			if self.storage == 'masked':
+				self.currents = np.ma.array(load('currents.npy'), mask=load('currents_mask.npy'))
+				self.background = np.ma.array(load('background.npy'), mask=load('background_mask.npy'))
+			else:
+				self.currents = load('currents.npy')
+				self.background = load('background.npy')
+			if self.storage == 'sparse':
+				self.set_chambers(np.load(cache_path + 'chambers.npy'))
+			self.luminosity = load('luminosity.npy')
+			self.timestamps = load('timestamps.npy')
+			self.appended = []
+		except (IOError, OSError, ValueError):
+			return False
+		
+		self.fill = info['fill']
+		self.wheels = np.array(info['wheels'], dtype=int)
+		self.stations = np.array(info['stations'], dtype=int)
+		self.sectors = np.array(info['sectors'], dtype=int)
+		self.loaded = True
+		return True
+			
+	# load one txt file (also compressed) or all txt files of an archive
+	def load_file(self, filename, fast=None):
+		if fast is None:
+			fast = self.fast
+		self.insert_chambers(self.parse(filename, fast))
+		
+	# parse file or archive (parse stage), returns list of read_chamber results
+	def parse(self, filename, fast=None):
+		if fast is None:
+			fast = self.fast
+		return self.count_parsed(self.instruments.call('parse', parse_chambers, filename, fast=fast))
+		
+	# count files and rows of a parse_chambers result, returns list of read_chamber results
+	def count_parsed(self, result):
+		chambers, files, rows = result
+		self.instruments.count('files parsed', files)
+		self.instruments.count('rows parsed', rows)
+		return chambers
+		
+	# insert chambers returned by read_chamber, with align the chambers are put on the time axis of loaded data
+	# (or a time axis built from the timestamps of the chambers if no data is loaded), axis: (timestamps, luminosity) of the time axis to use
+	def insert_chambers(self, chambers, axis=None):
+		chambers = [chamber for chamber in chambers if chamber is not None]
+		if not chambers:
+			return
+		if not self.align:
+			for chamber in chambers:
+				self.instruments.call('insert', self.insert_chamber, chamber)
+			return
+		
+		with self.instruments.timer('align'):
+			if axis is not None:
+				axis, luminosity = axis
+				rows = [axis_rows(axis, chamber[7], self.align_tolerance) for chamber in chambers]
+			elif self.currents is not None and len(self.timestamps):
+				axis = np.asarray(self.timestamps, dtype=np.int64)
+				luminosity = self.luminosity
+				rows = [axis_rows(axis, chamber[7], self.align_tolerance) for chamber in chambers]
+			else:
+				axis, luminosity, rows = time_axis([chamber[7] for chamber in chambers], [chamber[4] for chamber in chambers], self.align_tolerance, self.max_gap)
+		for chamber, chamber_rows in zip(chambers, rows):
+			fill, wheel, station, sector, _, currents, background, timestamps = chamber
+			with self.instruments.timer('align'):
+				currents = align_currents(axis, chamber_rows, timestamps, currents, self.max_gap)
+			self.instruments.call('insert', self.insert_chamber, (fill, wheel, station, sector, luminosity, currents, background, axis))
+		
+	# insert chamber data returned by read_chamber to global current data (rows are matched by position)
+	def insert_chamber(self, chamber):
+		if chamber is None:
+			return
+		self.fill, wheel, station, sector, luminosity, currents, background, timestamps = chamber
+		self.instruments.count('rows inserted', len(currents))# rows on the time axis with align (after ramp-up rows are left out)
 		
 		# number of different options
 		wheels = len(self.valid_wheels)
@@ -136,117 +874,385 @@ class DTCurrentData(object):
 		wires = len(self.valid_wires)
 		rows = len(currents)
 		
+		# sparse storage: blocks are merged into global arrays when data is used
+		if self.storage == 'sparse':
+			if not len(self.luminosity):
+				self.luminosity = luminosity
+				self.timestamps = timestamps
+			rows = min(rows, len(self.luminosity))
+			block = np.full((superlayers, layers, wires, len(self.luminosity)), np.nan, dtype=self.dtype)
+			bg = np.full((superlayers, layers, wires), np.nan, dtype=self.dtype)
+			if station == 4:
+				superlayers -= 1
+			block[:superlayers, :, :, :rows] = currents[:rows].T.reshape((superlayers, layers, wires, rows))
+			bg[:superlayers] = background.reshape((superlayers, layers, wires))
+			self._pending.append(((wheel, station, sector), block, bg))
+			self.changed()
+			return
+		
 		# create array to hold ALL files data
 		if self.currents is None:
 			shape = (wheels, stations, sectors, superlayers, layers, wires, rows)
-			self.currents = np.ma.array(np.zeros(shape, dtype=np.float), mask=True)
-			self.background = np.ma.array(np.zeros(shape, dtype=np.float), mask=True)
+			array = self.disk_array if self.chunk_rows else lambda name, shape, dtype, value: np.full(shape, value, dtype=dtype)
+			if self.storage == 'masked':
+				self.currents = np.ma.array(array('currents.npy', shape, self.dtype, 0), mask=array('currents_mask.npy', shape, bool, True))
+				self.background = np.ma.array(array('background.npy', shape[:6], self.dtype, 0), mask=array('background_mask.npy', shape[:6], bool, True))
+			else:
+				self.currents = array('currents.npy', shape, self.dtype, np.nan)
+				self.background = array('background.npy', shape[:6], self.dtype, np.nan)
 			self.luminosity = luminosity
+			self.timestamps = timestamps
 			
-		# insert this chamber data to global current data
+		# insert this chamber data to global current data (background is stored once per channel)
 		if station == 4:
 			superlayers -= 1
 		rows = min(rows, self.currents.shape[6])
 		shape = (superlayers, layers, wires, rows)
-		self.currents[wheel+2, station-1, sector-1, :superlayers, :, :, :rows] = currents[:rows].T.reshape(shape)
-		self.background[wheel+2, station-1, sector-1, :superlayers, :, :, :rows] = np.tile(background, rows).reshape((-1,len(background))).T.reshape(shape)
+		values = currents[:rows].T.reshape(shape)
+		if self.storage == 'masked':
+			values = np.ma.masked_invalid(values)# gaps in the time axis
+		self.currents[wheel+2, station-1, sector-1, :superlayers, :, :, :rows] = values
+		self.background[wheel+2, station-1, sector-1, :superlayers] = background.reshape(shape[:3])
+		self.changed()
+		
+	# out-of-core mode: array in a memory-mapped file of the cache dir (array in memory if the file can not be created)
+	def disk_array(self, name, shape, dtype, value):
+		cache_path = self.cache_path()
+		try:
+			if not os.path.isdir(cache_path):
+				os.makedirs(cache_path)
+			
+			# cached arrays are replaced, cache is valid only after new manifest is written
+			if os.path.exists(cache_path + 'manifest.json'):
+				os.remove(cache_path + 'manifest.json')
+			
+			# old file is removed instead of overwritten, other processes keep using their memory-mapped old file
+			if os.path.exists(cache_path + name):
+				os.remove(cache_path + name)
+			array = open_memmap(cache_path + name, mode='w+', dtype=dtype, shape=shape)
+		except (IOError, OSError) as e:
+			print('Could not create {name} in {path}: {error}'.format(name=name, path=cache_path, error=e))
+			return np.full(shape, value, dtype=dtype)
+		array[...] = value
+		self.disk_arrays[name] = array
+		return array
+		
+	# forget background subtracted currents and memoized query results after data is changed
+	def changed(self):
+		self._subtracted = None
+		self.memo.clear()
+		
+	# luminosity for each row, replacing it resets memoized query results
+	@property
+	def luminosity(self):
+		return self._luminosity
+		
+	@luminosity.setter
+	def luminosity(self, luminosity):
+		self._luminosity = luminosity
+		self.changed()
+		
+	# raw currents, replacing them resets the background subtracted currents
+	@property
+	def currents(self):
+		if self._pending:
+			self.instruments.call('merge blocks', self.merge_blocks)
+		return self._currents
+		
+	@currents.setter
+	def currents(self, currents):
+		self._currents = currents
+		self.changed()
+		
+	# background current for each channel (without rows axis)
+	@property
+	def background(self):
+		if self._pending:
+			self.instruments.call('merge blocks', self.merge_blocks)
+		return self._background
+		
+	@background.setter
+	def background(self, background):
+		self._background = background
+		self.changed()
+		
+	# background subtracted currents, calculated once and shared by all queries
+	@property
+	def subtracted(self):
+		if self._subtracted is None and self.currents is not None:
+			with self.instruments.timer('background subtraction'):
+				self._subtracted = self.subtract_background(self.currents)
+		return self._subtracted
+		
+	# currents (rows from start on) minus background, rows of appended fills use the background of their fill
+	def subtract_background(self, currents, start=0):
+		if not self.appended:
+			return currents - self.background[..., np.newaxis]
+		stop = start + currents.shape[-1]
+		segments = [(0, self.background)] + self.appended
+		parts = []
+		for i, (first, background) in enumerate(segments):
+			last = segments[i+1][0] if i+1 < len(segments) else stop
+			first, last = max(first, start), min(last, stop)
+			if first < last:
+				parts.append(currents[..., first-start:last-start] - background[..., np.newaxis])
+		if not parts:
+			return currents - self.background[..., np.newaxis]
+		if len(parts) == 1:
+			return parts[0]
+		if isinstance(parts[0], np.ma.MaskedArray):
+			return np.ma.concatenate(parts, axis=-1)
+		return np.concatenate(parts, axis=-1)
+		
+	# sparse storage: merge inserted chamber blocks into global arrays, blocks are sorted by (wheel, station, sector)
+	def merge_blocks(self):
+		pending = self._pending
+		self._pending = []
+		
+		chambers = np.array([p[0] for p in pending], dtype=int)
+		currents = np.array([p[1] for p in pending])
+		background = np.array([p[2] for p in pending])
+		if self._currents is not None:
+			chambers = np.vstack((self.chambers, chambers))
+			currents = np.concatenate((self._currents, currents))
+			background = np.concatenate((self._background, background))
+		
+		# last inserted block is used if a chamber was inserted several times (chambers loaded again)
+		_, last = np.unique(chamber_ids(chambers)[::-1], return_index=True)
+		keep = len(chambers) - 1 - last
+		self._currents = currents[keep]
+		self._background = background[keep]
+		self.set_chambers(chambers[keep])
+		self.changed()
+		
+	# sparse storage: set (wheel, station, sector) of blocks and rebuild chamber index
+	def set_chambers(self, chambers):
+		self.chambers = np.asarray(chambers, dtype=int).reshape((-1, 3))
+		self.index = -np.ones((5, 4, 12), dtype=int)
+		self.index[self.chambers[:, 0]+2, self.chambers[:, 1]-1, self.chambers[:, 2]-1] = np.arange(len(self.chambers))
+		
+	# append rows of another fill, background is subtracted separately for each fill (backgrounds of appended fills are kept in appended)
+	def append(self, other):
+		rows = len(self.luminosity)
+		appended = self.appended + [(rows, other.background)] + [(rows + first, background) for first, background in other.appended]
+		if self.storage == 'sparse':
+			# put blocks of both fills in the same chamber layout
+			chambers = np.unique(np.vstack((self.chambers, other.chambers)), axis=0)
+			ids = chamber_ids(chambers)
+			def expand(data, data_chambers):
+				out = np.full((len(chambers),) + data.shape[1:], np.nan, dtype=data.dtype)
+				out[np.searchsorted(ids, chamber_ids(data_chambers))] = data
+				return out
+			appended = [(first, expand(background, self.chambers if first < rows else other.chambers)) for first, background in appended]
+			self.background = expand(self.background, self.chambers)
+			self.currents = np.concatenate([expand(self.currents, self.chambers), expand(other.currents, other.chambers)], axis=4)
+			self.set_chambers(chambers)
+		else:
+			concatenate = np.ma.concatenate if self.storage == 'masked' else np.concatenate
+			self.currents = concatenate([self.currents, other.currents], axis=6)
+		self.appended = appended
+		self.luminosity = np.concatenate([self.luminosity, other.luminosity])
+		self.timestamps = np.concatenate([self.timestamps, other.timestamps])
+		
+		self.wheels = np.union1d(self.wheels, other.wheels)
+		self.stations = np.union1d(self.stations, other.stations)
+		self.sectors = np.union1d(self.sectors, other.sectors)
 		
 	# get mean values using specified filters
 	def get(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires', fit=None, get_slope=None, background=False):
+		self.instruments.count('get calls')
+		c = self.reduce(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire, background=background)
+		if c is None:
+			return
+		
+		# linear regression
+		if fit or get_slope:
+			# current = slope * luminosity + intercept
+			key = ('fit', wheel, station, sector, superlayer, layer, wire, bool(background), bool(self.robust))
+			slope, intercept = self.memoized(key, lambda: tuple(map(float, self.fit(c))))
+			
+			# return slope or fitted data?
+			if get_slope:
+				return slope
+			
+			return slope * self.luminosity + intercept
+			
+		return c
+		
+	# get mean values using specified filters, axes listed in groupby are kept (with all valid values)
+	# returns array with groupby axes (in groupby order) and rows axis, returned arrays are shared by memo
+	def reduce(self, groupby=(), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires', background=False):
+		key = ('reduce', tuple(groupby), wheel, station, sector, superlayer, layer, wire, bool(background))
+		return self.memoized(key, lambda: self.instruments.call('reduce', self._reduce, groupby, wheel, station, sector, superlayer, layer, wire, background))
+		
+	def _reduce(self, groupby, wheel, station, sector, superlayer, layer, wire, background):
 		if not self.loaded:
 			print("Data file is not loaded")
 			return
 		
+		for name in groupby:
+			if name not in self.keywords:
+				print("groupby values should be " + '|'.join(self.keywords))
+				return
+		
+		# check filter values
+		filters = [('wheel', wheel, self.valid_wheels), ('station', station, self.valid_stations), ('sector', sector, self.valid_sectors), \
+			('superlayer', superlayer, self.valid_superlayers), ('layer', layer, self.valid_layers)]
+		for name, value, valid in filters:
+			if not (name in groupby or value is None or value in valid):
+				print(name + " value should be " + '|'.join(map(str, valid)) + "|None")
+				return
+		if not ('wire' in groupby or wire == "wires" or wire in self.valid_wires):
+			print("wire value should be wire0|wire1|wires|cathode")
+			return
+		
+		# out-of-core mode: reduce chunks of rows, background (of the fill of each row) is subtracted from each chunk
+		if self.chunk_rows:
+			chunks = []
+			for start in range(0, max(len(self.luminosity), 1), self.chunk_rows):
+				c = self.currents[..., start:start+self.chunk_rows]
+				if not background:
+					c = self.subtract_background(c, start)
+				chunks.append(self.reduce_array(c, groupby, filters, wire))
+			if len(chunks) == 1:
+				return chunks[0]
+			if isinstance(chunks[0], np.ma.MaskedArray):
+				return np.ma.concatenate(chunks, axis=-1)
+			return np.concatenate(chunks, axis=-1)
+		
 		# subtract background (default) or use original values
 		if background:
 			c = self.currents
 		else:
-			c = self.currents - self.background
+			c = self.subtracted
+		return self.reduce_array(c, groupby, filters, wire)
 		
-		# filter by wheel
-		if wheel is None:
-			c = c.mean(0)
-		elif wheel in self.valid_wheels:
-			c = c[wheel+2]
-		else:
-			print("wheel value should be " + '|'.join(map(str, self.valid_wheels)) + "|None")
-			return
-			
-		# filter by station
-		if station is None:
-			c = c.mean(0)
-		elif station in self.valid_stations:
-			c = c[station-1]
-		else:
-			print("station value should be " + '|'.join(map(str, self.valid_stations)) + "|None")
-			return
+	# filter or average currents (with rows axis) by filters and wire, axes in groupby are kept
+	def reduce_array(self, c, groupby, filters, wire):
+		# sparse storage: reduce wheel, station and sector using only loaded chambers
+		axis = 0
+		if self.storage == 'sparse':
+			c = self.reduce_blocks(c, groupby, filters[:3])
+			axis = len([name for name, _, _ in filters[:3] if name in groupby])
+			filters = filters[3:]
+		
+		# filter by wheel, station, sector, superlayer and layer
+		for name, value, valid in filters:
+			if name in groupby:
+				axis += 1
+			elif value is None:
+				c = nanmean(c, axis)
+			else:
+				c = c[(slice(None),) * axis + (value - valid[0],)]
 			
-		# filter by sector
-		if sector is None:
-			c = c.mean(0)
-		elif sector in self.valid_sectors:
-			c = c[sector-1]
+		# filter by wire
+		index = (slice(None),) * axis
+		if 'wire' in groupby:
+			pass
+		elif wire == "wires":
+			c = (c[index + (0,)] + c[index + (1,)]) * 0.5
 		else:
-			print("sector value should be " + '|'.join(map(str, self.valid_sectors)) + "|None")
-			return
+			c = c[index + (self.valid_wires.index(wire),)]
+		
+		# order kept axes as in groupby
+		kept = [name for name in self.keywords if name in groupby]
+		return c.transpose([kept.index(name) for name in groupby] + [len(kept)])
+		
+	# sparse storage: filter or average blocks by wheel, station and sector (filters), axes in groupby are kept
+	# returns array with kept axes (all valid values, NaN for missing chambers) and superlayer, layer, wire, rows axes
+	def reduce_blocks(self, blocks, groupby, filters):
+		coords = self.chambers
+		valids = []
+		for name, value, valid in filters:
+			column = len(valids)
+			if name in groupby:
+				valids.append(valid)
+				continue
 			
-		# filter by superlayer
-		if superlayer is None:
-			c = c.mean(0)
-		elif superlayer in self.valid_superlayers:
-			c = c[superlayer-1]
-		else:
-			print("superlayer value should be " + '|'.join(map(str, self.valid_superlayers)) + "|None")
+			if value is not None:
+				# filter by value
+				selected = coords[:, column] == value
+				blocks = blocks[selected]
+				coords = coords[selected]
+			elif len(coords):
+				# mean over blocks with the same remaining coordinates
+				keys = np.ascontiguousarray(np.delete(coords, column, axis=1))
+				keys = keys.view([('', keys.dtype)] * keys.shape[1]).ravel() if keys.shape[1] else np.zeros(len(keys))
+				_, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+				order = np.argsort(inverse.ravel(), kind='mergesort')
+				starts = np.searchsorted(inverse.ravel()[order], np.arange(len(first)))
+				present = ~np.isnan(blocks[order])
+				sums = np.add.reduceat(np.where(present, blocks[order], 0), starts, axis=0)
+				counts = np.add.reduceat(present.astype(int), starts, axis=0)
+				with np.errstate(invalid='ignore', divide='ignore'):
+					blocks = (sums / counts).astype(blocks.dtype)
+				coords = coords[first]
+			coords = np.delete(coords, column, axis=1)
+		
+		# place blocks in array with kept axes
+		out = np.full(tuple(len(valid) for valid in valids) + blocks.shape[1:], np.nan, dtype=blocks.dtype)
+		if len(blocks):
+			out[tuple(coords[:, column] - valid[0] for column, valid in enumerate(valids))] = blocks
+		return out
+		
+	# valid values of a filter (values along a groupby axis of reduce, slopes and aggregate results)
+	def valid_values(self, name):
+		return {'wheel': self.valid_wheels, 'station': self.valid_stations, 'sector': self.valid_sectors, 'superlayer': self.valid_superlayers, 'layer': self.valid_layers, 'wire': self.valid_wires}[name]
+		
+	# index of filter value along a groupby axis of reduce, slopes and aggregate results
+	def position(self, name, value):
+		return list(self.valid_values(name)).index(value)
+		
+	# fit slopes and intercepts for all groupby combinations at once
+	# returns (slopes, intercepts) arrays with groupby axes, eg. slopes(groupby=('wheel', 'sector'))[0][wheel+2, sector-1]
+	def slopes(self, groupby=('wheel', 'sector'), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		c = self.reduce(groupby=groupby, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if c is None:
 			return
-			
-		# filter by layer
-		if layer is None:
-			c = c.mean(0)
-		elif layer in self.valid_layers:
-			c = c[layer-1]
-		else:
-			print("layer value should be " + '|'.join(map(str, self.valid_layers)) + "|None")
+		key = ('slopes', tuple(groupby), wheel, station, sector, superlayer, layer, wire, bool(self.robust))
+		return self.memoized(key, lambda: self.fit(c))
+		
+	# fit lines to currents (rows axis last), returns (slopes, intercepts)
+	def fit(self, c):
+		if self.robust:
+			return self.instruments.call('fit', robust_lines, self.luminosity, c)
+		return self.instruments.call('fit', fit_lines, self.luminosity, c)
+		
+	# statistic for every combination of by values at once
+	# stat: slope, mean (background subtracted current), maxcurrent, max (maximum background subtracted current)
+	# returns (labels, values): valid values of each by axis and array with by axes (NaN or 0 slope if data is unavailable)
+	# eg. (wheels, sectors), slopes = aggregate(stat='slope', by=('wheel', 'sector'), station=4)
+	def aggregate(self, stat='slope', by=('wheel', 'station', 'sector'), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		if stat not in ['slope', 'mean', 'maxcurrent', 'max']:
+			print("stat value should be slope|mean|maxcurrent|max")
 			return
-			
-		# filter by wire
-		if wire=="wires":
-			c = (c[0] + c[1]) * 0.5
-		elif wire == "wire0":
-			c = c[0]
-		elif wire == "wire1":
-			c = c[1]
-		elif wire == "cathode":
-			c = c[2]
+		by = tuple(by)
+		filters = dict(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		
+		if stat == 'slope':
+			result = self.slopes(groupby=by, **filters)
+			values = None if result is None else result[0]
 		else:
-			print("wire value should be wire0|wire1|wires|cathode")
+			c = self.reduce(groupby=by, background=(stat == 'maxcurrent'), **filters)
+			if c is None:
+				return
+			func = nanmean if stat == 'mean' else nanmax
+			key = ('aggregate', stat, by, wheel, station, sector, superlayer, layer, wire)
+			values = self.memoized(key, lambda: np.ma.filled(func(c, -1), np.nan))
+		if values is None:
 			return
+		return ([self.valid_values(name) for name in by], values)
 		
-		# linear regression
-		if fit or get_slope:
-			# fit only values above 0 (useful in cathode plots, where current vs lumi goes like 0000001234)
-			mask1 = c.data > 0
-			
-			# remove points that differs more than 0.02*3 from nearby values mean (outliers)
-			mask2 = np.insert((c[1:-1]*2 - c[:-2] - c[2:]) < 0.02 * 3, [0, -1], [True, True])
-			mask = mask1 * mask2 * ~c.mask
-			
-			intercept = 0
-			if mask.sum() < 10:# less than 10 points after masking, dont fit
-				slope = 0
-			else:
-				# current = slope * luminosity
-				# slope, = np.linalg.lstsq(self.luminosity[:,np.newaxis], retval)[0]
-				
-				# current = slope * luminosity + intercept
-				slope, intercept = np.linalg.lstsq(np.vstack([self.luminosity[mask], np.ones(len(self.luminosity[mask]))]).T, c[mask])[0]
-			
-			# return slope or fitted data?
-			if get_slope:
-				return slope
-			
-			return slope * self.luminosity + intercept
-			
-		return c
+	# return memoized value for key or calculate and store it (None results are not stored), arrays in the value are read only
+	def memoized(self, key, func):
+		key = tuple(k.item() if isinstance(k, np.generic) else k for k in key)
+		value = self.memo.lookup(key)
+		self.instruments.count('memo misses' if value is None else 'memo hits')
+		if value is None:
+			value = read_only(func())
+			if value is not None:
+				self.memo.store(key, value)
+		return value
 		
 	# return slope: d(current)/d(luminosity)
 	def slope(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
@@ -254,7 +1260,54 @@ class DTCurrentData(object):
 		
 	# return max current
 	def maxcurrent(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		return self.get(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire, background=True).max()
+		key = ('maxcurrent', wheel, station, sector, superlayer, layer, wire)
+		return self.memoized(key, lambda: nanmax(self.get(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire, background=True)))
+		
+	# slopes fitted in sliding time windows (window and step in seconds), all groupby combinations at once
+	# windows are summed from cumulative sums of the points used in the fit of the whole fill (same outliers), with robust each window is fitted with robust_lines
+	# returns (times, slopes): window centers (epoch seconds) and slopes array with groupby axes and windows axis
+	def slope_vs_time(self, window=3600, step=600, groupby=(), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		c = self.reduce(groupby=groupby, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if c is None:
+			return
+		if window <= 0 or step <= 0:
+			print("window and step should be positive")
+			return
+		key = ('slope_vs_time', window, step, tuple(groupby), wheel, station, sector, superlayer, layer, wire, bool(self.robust))
+		return self.memoized(key, lambda: self.instruments.call('fit', self.window_slopes, c, window, step))
+		
+	def window_slopes(self, c, window, step):
+		timestamps = np.asarray(self.timestamps)
+		if not len(timestamps) or timestamps[-1] - timestamps[0] < window:
+			return (np.zeros(0), np.zeros(np.shape(c)[:-1] + (0,)))
+		
+		# window start and end rows
+		starts = np.arange(timestamps[0], timestamps[-1] - window + 1, step)
+		first = np.searchsorted(timestamps, starts)
+		last = np.searchsorted(timestamps, starts + window)
+		
+		# robust mode: robust_lines fit of each window
+		if self.robust:
+			luminosity = np.asarray(self.luminosity)
+			slopes = [robust_lines(luminosity[a:b], c[..., a:b])[0] for a, b in zip(first, last)]
+			return (starts + window * 0.5, np.stack(slopes, axis=-1))
+		
+		# cumulative sums of values centered by mean of the whole fill (with 0 before the first row)
+		mask = fit_mask(c)
+		points = np.maximum(mask.sum(-1), 1)
+		x0 = np.where(mask, self.luminosity, 0).sum(-1) / points
+		y0 = np.where(mask, np.ma.getdata(c), 0).sum(-1) / points
+		x = np.where(mask, self.luminosity - x0[..., np.newaxis], 0)
+		y = np.where(mask, np.ma.getdata(c).astype(float) - y0[..., np.newaxis], 0)
+		def window_sum(values):
+			cumulative = np.concatenate((np.zeros(values.shape[:-1] + (1,)), np.cumsum(values, axis=-1)), axis=-1)
+			return cumulative[..., last] - cumulative[..., first]
+		n = window_sum(mask)
+		sx = window_sum(x)
+		sy = window_sum(y)
+		count = np.maximum(n, 1)
+		sums = (n, x0[..., np.newaxis] + sx / count, y0[..., np.newaxis] + sy / count, window_sum(x * x) - sx * sx / count, window_sum(x * y) - sx * sy / count)
+		return (starts + window * 0.5, sums_to_lines(sums)[0])
 		
 	# return current for each luminosity
 	def current_vs_lumi(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
@@ -262,50 +1315,54 @@ class DTCurrentData(object):
 		ys = self.get(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
 		return (xs, ys)
 		
+	# return luminosity binned profile of currents (for plots of long fills), all groupby combinations at once
+	# returns (luminosity, mean, spread, count): bin centers and mean, standard deviation and number of currents in each bin
+	def current_vs_lumi_profile(self, bins=100, groupby=(), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		c = self.reduce(groupby=groupby, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if c is None:
+			return
+		key = ('profile', bins, tuple(groupby), wheel, station, sector, superlayer, layer, wire)
+		return self.memoized(key, lambda: profile(self.luminosity, c, bins))
+		
 	# return fitted current for each luminosity
 	def current_vs_lumi_fit(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
 		xs = self.luminosity
 		ys = self.get(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire, fit=1)
 		return (xs, ys)
 		
+	# return statistic for each loaded value of name (filter value of name is not used)
+	def aggregate_vs(self, stat, name, filters):
+		filters = dict(filters, **{name: None})
+		result = self.aggregate(stat=stat, by=(name,), **filters)
+		if result is None:
+			return (np.array([]), np.array([]))
+		(valid,), values = result
+		xs = getattr(self, name + 's')
+		return (xs, values[np.searchsorted(valid, xs)])
+		
 	# return slope for each wheel
 	def slope_vs_wheel(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		ys = [self.slope(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire) for wheel in self.wheels]
-		return (self.wheels, np.array(ys))
+		return self.aggregate_vs('slope', 'wheel', dict(station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire))
 	
 	# return max current for each wheel
 	def maxcurrent_vs_wheel(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		ys = [self.maxcurrent(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire) for wheel in self.wheels]
-		return (self.wheels, np.array(ys))
+		return self.aggregate_vs('maxcurrent', 'wheel', dict(station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire))
 		
 	# return slope for each station
 	def slope_vs_station(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		ys = [self.slope(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire) for station in self.stations]
-		return (self.stations, np.array(ys))
+		return self.aggregate_vs('slope', 'station', dict(wheel=wheel, sector=sector, superlayer=superlayer, layer=layer, wire=wire))
 		
 	# return max current for each station
 	def maxcurrent_vs_station(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		ys = [self.maxcurrent(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire) for station in self.stations]
-		return (self.stations, np.array(ys))
+		return self.aggregate_vs('maxcurrent', 'station', dict(wheel=wheel, sector=sector, superlayer=superlayer, layer=layer, wire=wire))
 		
 	# return slope for each sector
 	def slope_vs_sector(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		xs = []
-		ys = []
-		for sector in self.sectors:
-			slope = self.slope(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
-			if slope > 0:
-				xs.append(sector)
-				ys.append(slope)
-		return (np.array(xs), np.array(ys))
+		xs, ys = self.aggregate_vs('slope', 'sector', dict(wheel=wheel, station=station, superlayer=superlayer, layer=layer, wire=wire))
+		return (xs[ys > 0], ys[ys > 0])
 		
 	# return max current for each sector
 	def maxcurrent_vs_sector(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
-		xs = []
-		ys = []
-		for sector in self.sectors:
-			maxcurrent = self.maxcurrent(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
-			if maxcurrent > 0:
-				xs.append(sector)
-				ys.append(maxcurrent)
-		return (np.array(xs), np.array(ys))
\ No newline at end of file
+		xs, ys = self.aggregate_vs('maxcurrent', 'sector', dict(wheel=wheel, station=station, superlayer=superlayer, layer=layer, wire=wire))
+		with np.errstate(invalid='ignore'):
+			return (xs[ys > 0], ys[ys > 0])
@@ -0,0 +1,117 @@
+import glob
+import collections
+import DTCurrentData
+import numpy as np
+
+# collection of many fills, each fill is loaded when it is used first
+# usage:
+# DTCurrentFillSet('fills/*/') or DTCurrentFillSet(['fills/4364/', 'fills/4381/'])
+
+class DTCurrentFillSet(object):
+	def __init__(self, paths=[], max_loaded=4, **options):
+		# fill dirs or fill archives (string is expanded as glob pattern)
+		if isinstance(paths, str):
+			paths = sorted(glob.glob(paths))
+		self.paths = [path.rstrip('/')+'/' for path in paths]
+		
+		# number of fills kept in memory, least recently used fills are dropped (cached fills are memory-mapped, reloading is fast)
+		self.max_loaded = max_loaded
+		
+		# options passed to DTCurrentData (eg. storage, dtype)
+		self.options = options
+		
+		self.loaded = collections.OrderedDict()
+		self.numbers = {}
+	
+	def __len__(self):
+		return len(self.paths)
+	
+	# return DTCurrentData of fill dir nr index
+	def data(self, index):
+		path = self.paths[index]
+		if path in self.loaded:
+			data = self.loaded.pop(path)
+		else:
+			data = DTCurrentData.DTCurrentData(path, **self.options)
+			self.numbers[path] = data.fill
+		self.loaded[path] = data
+		
+		while len(self.loaded) > max(self.max_loaded, 1):
+			self.loaded.popitem(last=False)
+		return data
+	
+	# return fill number of fill dir nr index (read from file header, data is not loaded)
+	def fill(self, index):
+		path = self.paths[index]
+		if path not in self.numbers:
+			self.numbers[path] = ''
+			for filename in DTCurrentData.data_files(path):
+				header = DTCurrentData.read_header(filename)
+				if header is not None:
+					self.numbers[path] = header[0]
+					break
+		return self.numbers[path]
+	
+	# fill numbers of all fill dirs
+	def fills(self):
+		return [self.fill(index) for index in range(len(self.paths))]
+	
+	# indexes of selected fill numbers (None = all fills)
+	def select(self, fills=None):
+		if fills is None:
+			return list(range(len(self.paths)))
+		fills = [str(fill) for fill in fills]
+		return [index for index in range(len(self.paths)) if self.fill(index) in fills]
+	
+	# return slope for each fill
+	def slope_vs_fill(self, fills=None, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		xs = []
+		ys = []
+		for index in self.select(fills):
+			slope = self.data(index).slope(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+			if slope is not None and slope > 0:
+				xs.append(int(self.fill(index)))
+				ys.append(slope)
+		return (np.array(xs), np.array(ys))
+	
+	# return max current for each fill
+	def maxcurrent_vs_fill(self, fills=None, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		xs = []
+		ys = []
+		for index in self.select(fills):
+			maxcurrent = self.data(index).maxcurrent(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+			if maxcurrent is not None and maxcurrent > 0:
+				xs.append(int(self.fill(index)))
+				ys.append(maxcurrent)
+		return (np.array(xs), np.array(ys))
+	
+	# fit one line to data of all selected fills, fit sums of each fill are combined (data is not concatenated)
+	# with robust=True the reduced currents of the fills are concatenated and fitted with robust_lines (like DTCurrentData)
+	# returns (slopes, intercepts) arrays with groupby axes like DTCurrentData.slopes
+	def slopes(self, fills=None, groupby=(), wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		sums = None
+		luminosity = []
+		currents = []
+		for index in self.select(fills):
+			data = self.data(index)
+			c = data.reduce(groupby=groupby, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+			if c is None:
+				continue
+			if data.robust:
+				luminosity.append(np.asarray(data.luminosity))
+				currents.append(np.ma.masked_invalid(c))
+				continue
+			fill_sums = DTCurrentData.line_sums(data.luminosity, c)
+			sums = fill_sums if sums is None else DTCurrentData.merge_sums(sums, fill_sums)
+		if currents:
+			return DTCurrentData.robust_lines(np.concatenate(luminosity), np.ma.concatenate(currents, axis=-1))
+		if sums is None:
+			return
+		return DTCurrentData.sums_to_lines(sums)
+	
+	# return slope of one line fitted to data of all selected fills
+	def slope(self, fills=None, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		result = self.slopes(fills=fills, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if result is None:
+			return
+		return float(result[0])
@@ -1,4 +1,7 @@
 import DTCurrentData
+import os
+import time
+import multiprocessing
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -7,7 +10,13 @@ import numpy as np
 # DTCurrentPlot('pathname/')
 
 class DTCurrentPlot(object):
-	def __init__(self, path=''):
+	def __init__(self, path='', max_points=20000, profile_bins=100, **options):
+		# options passed to DTCurrentData (eg. storage, instrument)
+		self.options = options
+		
+		# current vs luminosity plots of fills with more than max_points rows show mean and spread in profile_bins luminosity bins
+		self.max_points = max_points
+		self.profile_bins = profile_bins
 		self.load_data(path)
 		
 		#self.plot_data()
@@ -15,25 +24,52 @@ class DTCurrentPlot(object):
 	# load files
 	def load_data(self, path):
 		self.path = path.rstrip('/')+'/'
-		self.data = DTCurrentData.DTCurrentData(self.path)
+		self.output = DTCurrentData.output_dir(self.path)# plots of a fill archive are saved next to it
+		self.data = DTCurrentData.DTCurrentData(self.path, **self.options)
+		self.instruments = self.data.instruments
 		self.args = {'luminosity': [1], 'wheel': self.data.wheels, 'station': self.data.stations, 'sector': self.data.sectors, 'superlayer': self.data.valid_superlayers, 'layer': self.data.valid_layers, 'wire': self.data.valid_wires}
 		self.labels = {'wheel': 'YB{:+d}', 'station': 'MB{}', 'sector': 'S{:02d}', 'superlayer': 'SL{}', 'layer': 'L{}', 'wire': '{}'}
 		self.keywords = ['wheel', 'station', 'sector', 'superlayer', 'layer', 'wire']
 		
-	# plot data
-	def plot_data(self):
+	# plot data, plots are planned first and rendered in a process pool if workers > 1, returns names of saved files
+	def plot_data(self, workers=1):
+		plots = self.instruments.call('plan', self.plan_data)
+		
+		# render plots (unavailable plots are None)
+		plots = [plot for plot in plots if plot is not None]
+		with self.instruments.timer('render'):
+			if workers > 1 and len(plots) > 1:
+				pool = multiprocessing.Pool(min(workers, len(plots)), initializer=use_agg)
+				try:
+					pool.map(render_plot, plots, chunksize=1)
+				finally:
+					pool.close()
+					pool.join()
+			else:
+				for plot in plots:
+					render_plot(plot)
+		saved = [plot['filename'] + '.' + plot['format'] for plot in plots if plot['format'] is not None]
+		self.instruments.count('plots saved', len(saved))
+		if self.instruments.enabled:
+			print(self.instruments.report())
+		return saved
+		
+	# plot descriptions of plot_data
+	def plan_data(self):
+		plots = []
 		for wire in ['wires', 'cathode']:
 			for station in self.data.stations:
-				self.draw(y='slope', x='sector', series='wheel', station=station, wire=wire)
-				self.draw(y='maxcurrent', x='sector', series='wheel', station=station, wire=wire)
+				plots.append(self.plan(y='slope', x='sector', series='wheel', station=station, wire=wire))
+				plots.append(self.plan(y='maxcurrent', x='sector', series='wheel', station=station, wire=wire))
 				for wheel in self.data.wheels:
-					self.draw(y='slope', x='sector', series='superlayer', wheel=wheel, station=station, wire=wire)
-					self.draw(y='maxcurrent', x='sector', series='superlayer', wheel=wheel, station=station, wire=wire)
+					plots.append(self.plan(y='slope', x='sector', series='superlayer', wheel=wheel, station=station, wire=wire))
+					plots.append(self.plan(y='maxcurrent', x='sector', series='superlayer', wheel=wheel, station=station, wire=wire))
 					for sector in self.data.sectors:
-						self.draw(y='current', x='luminosity', series='superlayer', wheel=wheel, station=station, sector=sector, wire=wire)
-		self.draw(y='slope', x='wheel', series='superlayer', station=station, sector=4)
-		self.draw(y='maxcurrent', x='wheel', series='superlayer', station=station, sector=4)
-		self.draw_slope_2d(station=4)
+						plots.append(self.plan(y='current', x='luminosity', series='superlayer', wheel=wheel, station=station, sector=sector, wire=wire))
+		plots.append(self.plan(y='slope', x='wheel', series='superlayer', station=station, sector=4))
+		plots.append(self.plan(y='maxcurrent', x='wheel', series='superlayer', station=station, sector=4))
+		plots.append(self.plan_slope_2d(station=4))
+		return plots
 		
 	def build_filterargs(self, filters={}):
 		return dict(
@@ -44,44 +80,60 @@ class DTCurrentPlot(object):
 			layer=filters['layer'] if 'layer' in filters else None, \
 			wire=filters['wire'] if 'wire' in filters else 'wires')
 		
+	# plot call of profile index (mean and spread in each luminosity bin)
+	def profile_call(self, profiles, index, color, label):
+		centers, mean, spread, count = profiles
+		return ('errorbar', (centers, mean[index]), dict(yerr=spread[index], fmt='.', color=color, label=label))
+		
+	# slope or maxcurrent for every value of x (one aggregate query), values <= 0 are removed
 	def getdata(self, x, y, filters={}):
-		func = {'slope': self.data.slope, 'maxcurrent': self.data.maxcurrent}
-
-		xs = []
-		ys = []
+		filters = dict(filters)
+		filters[x] = None
+		result = self.data.aggregate(stat=y, by=(x,), **self.build_filterargs(filters))
+		if result is None:
+			return (np.array([]), np.array([]))
+		_, values = result
 		
-		for arg in self.args[x]:
-			filters[x] = arg
-			val = func[y](**self.build_filterargs(filters))
-				
-			if val > 0:
-				xs.append(arg)
-				ys.append(val)
-				
-		return (np.array(xs), np.array(ys)*(1e6 if y=='slope' else 1))
+		xs = np.array(self.args[x])
+		ys = values[[self.data.position(x, arg) for arg in xs]]
+		with np.errstate(invalid='ignore'):
+			found = ys > 0
+		return (xs[found], ys[found]*(1e6 if y=='slope' else 1))
 		
-	def draw(self, x='sector', y='slope', series=None, format='png', wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):	
+	# draw plot, show on the screen (format=None) or save in the data dir
+	def draw(self, x='sector', y='slope', series=None, format='png', wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		plot = self.instruments.call('plan', self.plan, x=x, y=y, series=series, format=format, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if plot is not None:
+			self.render(plot)
+			
+	# get data for a plot, returns plot description for render_plot or None if data is unavailable
+	def plan(self, x='sector', y='slope', series=None, format='png', wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
 		filters = {'wheel':wheel, 'station':station, 'sector':sector, 'superlayer':superlayer, 'layer':layer, 'wire':wire}
 		colors = 'rgbcymk'
+		calls = []
 		
 		xss = []
 		plots = 0
 		if series is None:
 			if y == 'current':
 				kwargs = self.build_filterargs(filters)
-					
-				slope = self.data.slope(**kwargs)
-				if slope == 0:# unavailable data or constant values
+				
+				lines = self.data.slopes(groupby=(), **kwargs)
+				if lines is None or lines[0] == 0:# unavailable data or constant values
 					print('unavailable data, args: ', kwargs)
 					return
+				slope, intercept = lines
 				
-				xs, ys = self.data.current_vs_lumi(**kwargs)
-				plt.plot(xs, ys, '.', c=colors[0], label='current')
-				
-				xs, ys = self.data.current_vs_lumi_fit(**kwargs)
-				plt.plot(xs, ys, '--', c=colors[0], label='{:.2f} pA/Lumi'.format(slope*1e6))
+				if len(self.data.luminosity) > self.max_points:
+					profiles = self.data.current_vs_lumi_profile(bins=self.profile_bins, **kwargs)
+					xs = profiles[0]
+					calls.append(self.profile_call(profiles, (), colors[0], 'current'))
+				else:
+					xs, ys = self.data.current_vs_lumi(**kwargs)
+					calls.append(('plot', (xs, ys, '.'), dict(c=colors[0], label='current')))
+				calls.append(('plot', (xs, slope * xs + intercept, '--'), dict(c=colors[0], label='{:.2f} pA/Lumi'.format(slope*1e6))))
 				
-				plt.legend(loc='upper center', ncol=1, frameon=False, numpoints=1)
+				calls.append(('legend', (), dict(loc='upper center', ncol=1, frameon=False, numpoints=1)))
 			else:
 				xs, ys = self.getdata(x=x, y=y, filters=filters)
 			
@@ -90,23 +142,35 @@ class DTCurrentPlot(object):
 					return
 				
 				xss = xs
-				plt.plot(xs, ys, 'o')
+				calls.append(('plot', (xs, ys, 'o'), {}))
 		else:
+			if y == 'current':
+				# fits and currents of all series at once
+				kwargs = self.build_filterargs(dict(filters, **{series: None}))
+				lines = self.data.slopes(groupby=(series,), **kwargs)
+				currents = self.data.reduce(groupby=(series,), **kwargs)
+				if lines is None or currents is None:
+					return
+				profiles = None
+				if len(self.data.luminosity) > self.max_points:
+					profiles = self.data.current_vs_lumi_profile(bins=self.profile_bins, groupby=(series,), **kwargs)
+				
 			for arg_nr, arg in enumerate(self.args[series]):
 				filters[series] = arg
 				
 				if y == 'current':
-					kwargs = self.build_filterargs(filters)
-					
-					slope = self.data.slope(**kwargs)
+					i = self.data.position(series, arg)
+					slope, intercept = lines[0][i], lines[1][i]
 					if slope == 0:# unavailable data or constant values
 						continue
 					
-					xs, ys = self.data.current_vs_lumi(**kwargs)
-					plt.plot(xs, ys, '.', c=colors[arg_nr], label=self.labels[series].format(arg))
-					
-					xs, ys = self.data.current_vs_lumi_fit(**kwargs)
-					plt.plot(xs, ys, '--', c=colors[arg_nr], label='{:.2f} pA/Lumi'.format(slope*1e6))
+					if profiles is not None:
+						xs = profiles[0]
+						calls.append(self.profile_call(profiles, i, colors[arg_nr], self.labels[series].format(arg)))
+					else:
+						xs, ys = self.data.luminosity, currents[i]
+						calls.append(('plot', (xs, ys, '.'), dict(c=colors[arg_nr], label=self.labels[series].format(arg))))
+					calls.append(('plot', (xs, slope * xs + intercept, '--'), dict(c=colors[arg_nr], label='{:.2f} pA/Lumi'.format(slope*1e6))))
 				else:
 					xs, ys = self.getdata(x=x, y=y, filters=filters)
 						
@@ -114,7 +178,7 @@ class DTCurrentPlot(object):
 						continue
 						
 					xss.extend(xs)
-					plt.plot(xs, ys, 'o', label=self.labels[series].format(arg))
+					calls.append(('plot', (xs, ys, 'o'), dict(label=self.labels[series].format(arg))))
 				plots += 1
 			
 			if plots == 0:
@@ -123,9 +187,9 @@ class DTCurrentPlot(object):
 				
 			xss = np.unique(xss)
 			if y == 'current':
-				plt.legend(loc='upper center', ncol=plots, frameon=False, numpoints=1)
+				calls.append(('legend', (), dict(loc='upper center', ncol=plots, frameon=False, numpoints=1)))
 			else:
-				plt.legend(loc='best', numpoints=1)
+				calls.append(('legend', (), dict(loc='best', numpoints=1)))
 			
 		# filename
 		filename = y + '_vs_' + x
@@ -147,55 +211,123 @@ class DTCurrentPlot(object):
 				title += ' ' + self.labels[keyword].format(filters[keyword])
 				filename += '_' + self.labels[keyword].format(filters[keyword])
 		
-		plt.title(title)
+		calls.append(('title', (title,), {}))
 		
 		# axes labels
 		if y == 'slope':
-			plt.ylabel(r'$pA / Lumi$')
+			calls.append(('ylabel', (r'$pA / Lumi$',), {}))
 		elif y == 'current':
-			plt.xlabel(r'Instantaneous Luminosity ($\mu barn^{-1} \cdot s^{-1}$)')
-			plt.ylabel(r'Current ($\mu A$)')
+			calls.append(('xlabel', (r'Instantaneous Luminosity ($\mu barn^{-1} \cdot s^{-1}$)',), {}))
+			calls.append(('ylabel', (r'Current ($\mu A$)',), {}))
 		
-		if x is not 'luminosity':
-			plt.xlim(xmin=xss.min()-0.5, xmax=xss.max()+0.5)
-			plt.xticks(xss, [self.labels[x].format(_x) for _x in xss])
+		if x != 'luminosity':
+			calls.append(('xlim', (), dict(xmin=xss.min()-0.5, xmax=xss.max()+0.5)))
+			calls.append(('xticks', (xss, [self.labels[x].format(_x) for _x in xss]), {}))
 		
-		plt.grid()
+		calls.append(('grid', (), {}))
 		
-		# save plot
-		self.plot_end(filename=filename, format=format)
+		return {'calls': calls, 'path': self.output, 'filename': filename, 'format': format}
+		
+	# draw slopes fitted in sliding time windows (window and step in seconds)
+	def draw_slope_vs_time(self, window=3600, step=600, series=None, format='png', wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		plot = self.instruments.call('plan', self.plan_slope_vs_time, window=window, step=step, series=series, format=format, wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if plot is not None:
+			self.render(plot)
+			
+	# get data for slope vs time plot, returns plot description for render_plot or None if data is unavailable
+	def plan_slope_vs_time(self, window=3600, step=600, series=None, format='png', wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		filters = {'wheel':wheel, 'station':station, 'sector':sector, 'superlayer':superlayer, 'layer':layer, 'wire':wire}
+		groupby = () if series is None else (series,)
+		kwargs = self.build_filterargs(dict(filters, **{series: None}) if series is not None else filters)
+		result = self.data.slope_vs_time(window=window, step=step, groupby=groupby, **kwargs)
+		if result is None or not len(result[0]):
+			print('unavailable data, args: ', kwargs)
+			return
+		times, slopes = result
+		
+		# hours since the start of the fill
+		xs = (times - self.data.timestamps[0]) / 3600.
+		calls = []
+		if series is None:
+			calls.append(('plot', (xs, slopes*1e6, 'o-'), {}))
+		else:
+			plots = 0
+			for arg in self.args[series]:
+				ys = slopes[self.data.position(series, arg)]
+				if ys.max() <= 0:# unavailable data
+					continue
+				calls.append(('plot', (xs, ys*1e6, 'o-'), dict(label=self.labels[series].format(arg))))
+				plots += 1
+			if plots == 0:
+				print('Unavailable data')
+				return
+			calls.append(('legend', (), dict(loc='best', numpoints=1)))
+		
+		# filename and labels
+		filename = 'slope_vs_time'
+		if series is not None:
+			filename += '_every_' + series
+		title = 'Average {place} Current vs Luminosity, {window:g} min windows'.format(place=wire, window=window/60.)
+		title += '\nFill {fill}'.format(fill=self.data.fill)
+		for keyword in self.keywords:
+			if series != keyword and filters[keyword] is not None:
+				title += ' ' + self.labels[keyword].format(filters[keyword])
+				filename += '_' + self.labels[keyword].format(filters[keyword])
+		calls.append(('title', (title,), {}))
+		calls.append(('xlabel', ('Time since {start} UTC (h)'.format(start=time.strftime('%d-%m-%Y %H:%M', time.gmtime(self.data.timestamps[0]))),), {}))
+		calls.append(('ylabel', (r'$pA / Lumi$',), {}))
+		calls.append(('grid', (), {}))
+		
+		return {'calls': calls, 'path': self.output, 'filename': filename, 'format': format}
 		
 	# draw 2d plot with colormap: 	
 	def draw_slope_2d(self, station=4, wire='wires', format='png'):
-		values = []
-		for wheel in self.data.wheels:
-			values.append([self.data.slope(wheel=wheel, sector=sector, wire=wire) for sector in self.data.sectors])
-		values = np.array(values) * 1e6
+		self.render(self.instruments.call('plan', self.plan_slope_2d, station=station, wire=wire, format=format))
+		
+	# render one plot in this process
+	def render(self, plot):
+		self.instruments.call('render', render_plot, plot)
+		if plot['format'] is not None:
+			self.instruments.count('plots saved')
 		
-		fig, ax = plt.subplots()
+	# get data for 2d slope plot, returns plot description for render_plot
+	def plan_slope_2d(self, station=4, wire='wires', format='png'):
+		(wheels, sectors), slopes = self.data.aggregate(stat='slope', by=('wheel', 'sector'), wire=wire)
+		values = slopes[np.ix_(np.searchsorted(wheels, self.data.wheels), np.searchsorted(sectors, self.data.sectors))] * 1e6
 		
-		im = ax.pcolor(values[::-1], cmap='OrRd', edgecolor='black', linestyle=':', lw=1)
-		fig.colorbar(im)
+		calls = []
+		calls.append(('pcolor', (values[::-1],), dict(cmap='OrRd', edgecolor='black', linestyle=':', lw=1)))
+		calls.append(('colorbar', (), {}))
 		
 		# labels
-		ax.xaxis.set(ticks=np.arange(len(self.data.sectors))+0.5, ticklabels=[self.labels['sector'].format(sector) for sector in self.data.sectors])
-		ax.yaxis.set(ticks=np.arange(len(self.data.wheels))+0.5, ticklabels=[self.labels['wheel'].format(wheel) for wheel in self.data.wheels][::-1])
+		calls.append(('xticks', (np.arange(len(self.data.sectors))+0.5, [self.labels['sector'].format(sector) for sector in self.data.sectors]), {}))
+		calls.append(('yticks', (np.arange(len(self.data.wheels))+0.5, [self.labels['wheel'].format(wheel) for wheel in self.data.wheels][::-1]), {}))
 		#plt.xlabel('Sector')
 		#plt.ylabel('Wheel')
-		plt.title(r'Fill {fill} MB{station} slope $pA \cdot \mu barn \cdot s$'.format(fill=self.data.fill, station=station))
+		calls.append(('title', (r'Fill {fill} MB{station} slope $pA \cdot \mu barn \cdot s$'.format(fill=self.data.fill, station=station),), {}))
 		
 		# save plot
 		filename = 'slope2d_{wire}_MB{station}' \
 				.format(wire=wire, station=station)
-		self.plot_end(filename=filename, format=format)
+		return {'calls': calls, 'path': self.output, 'filename': filename, 'format': format}
 		
-	# show or save plot
-	def plot_end(self, filename='', format='png'):
-		plt.tight_layout()
-		if format is None:
-			plt.show()
-		else:
-			filename += '.' + format
-			plt.savefig(self.path + filename, bbox_inches='tight')
-			print('Saved ' + filename)
-		plt.clf()
\ No newline at end of file
+# use non-interactive backend in plot rendering processes
+def use_agg():
+	plt.switch_backend('Agg')
+	
+# render plot description (list of pyplot calls), show on the screen or save
+def render_plot(plot):
+	plt.figure()
+	for name, args, kwargs in plot['calls']:
+		getattr(plt, name)(*args, **kwargs)
+	
+	plt.tight_layout()
+	if plot['format'] is None:
+		plt.show()
+	else:
+		filename = plot['filename'] + '.' + plot['format']
+		if plot['path'] and not os.path.isdir(plot['path']):
+			os.makedirs(plot['path'])
+		plt.savefig(plot['path'] + filename, bbox_inches='tight')
+		print('Saved ' + filename)
+	plt.close()
\ No newline at end of file
@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import threading
+import collections
+import numpy as np
+import DTCurrentData
+try:
+	import socketserver
+	from multiprocessing import shared_memory
+except ImportError:# python 2
+	socketserver = None
+	shared_memory = None
+
+# query server: loads fills once, publishes arrays in shared memory and answers queries over a local unix socket
+# clients attach zero-copy DTCurrentData views of the shared arrays (python 3.8 or newer)
+# usage:
+# python DTCurrentServer.py fills/4364/ fills/4381/ --socket /tmp/dtcurrent.sock
+# client = DTCurrentClient('/tmp/dtcurrent.sock')
+# data = client.attach('fills/4364/')
+# slope = client.query('fills/4364/', 'slope', station=4)
+
+# default socket address
+SOCKET = '/tmp/dtcurrent.sock'
+
+# DTCurrentData methods answered by the server
+QUERIES = ['get', 'slope', 'maxcurrent', 'slopes', 'aggregate', 'current_vs_lumi', 'current_vs_lumi_fit', 'current_vs_lumi_profile', 'slope_vs_time',
+	'slope_vs_wheel', 'maxcurrent_vs_wheel', 'slope_vs_station', 'maxcurrent_vs_station', 'slope_vs_sector', 'maxcurrent_vs_sector']
+
+# query results as json values (tuples and arrays are tagged, NaN for masked values)
+def encode(value):
+	if isinstance(value, tuple):
+		return {'tuple': [encode(v) for v in value]}
+	if isinstance(value, list):
+		return [encode(v) for v in value]
+	if isinstance(value, np.ndarray):
+		array = np.ma.asarray(value)
+		array = np.ma.filled(array, np.nan) if array.dtype.kind == 'f' else np.ma.getdata(array)
+		if array.ndim == 0:
+			return array.item()
+		return {'array': array.tolist(), 'dtype': array.dtype.str}
+	if isinstance(value, np.generic):
+		return value.item()
+	return value
+
+# query results from json values
+def decode(value):
+	if isinstance(value, dict):
+		if 'tuple' in value:
+			return tuple(decode(v) for v in value['tuple'])
+		return np.array(value['array'], dtype=value['dtype'])
+	if isinstance(value, list):
+		return [decode(v) for v in value]
+	return value
+
+# copy loaded arrays of data to shared memory blocks and use the shared arrays in data
+# returns (blocks, arrays): shared memory blocks and {name: (block name, shape, dtype)}
+def share(data):
+	subtracted = data.subtracted
+	arrays = {'luminosity': np.asarray(data.luminosity), 'timestamps': np.asarray(data.timestamps, dtype=np.int64)}
+	for name, array in [('currents', data.currents), ('background', data.background), ('subtracted', subtracted)]:
+		arrays[name] = np.ma.getdata(array)
+		if data.storage == 'masked':
+			arrays[name + '_mask'] = np.ma.getmaskarray(array)
+	if data.storage == 'sparse':
+		arrays['chambers'] = data.chambers
+	
+	blocks = []
+	shared = {}
+	info = {}
+	for name, array in arrays.items():
+		block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+		blocks.append(block)
+		shared[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+		shared[name][...] = array
+		info[name] = (block.name, array.shape, array.dtype.str)
+	set_arrays(data, shared)
+	return (blocks, info)
+
+# put shared arrays in data (read only, background subtracted currents are not calculated again)
+def set_arrays(data, arrays):
+	for array in arrays.values():
+		array.flags.writeable = False
+	if data.storage == 'masked':
+		masked = lambda name: np.ma.array(arrays[name], mask=arrays[name + '_mask'], copy=False)
+		data.currents = masked('currents')
+		data.background = masked('background')
+		subtracted = masked('subtracted')
+	else:
+		data.currents = arrays['currents']
+		data.background = arrays['background']
+		subtracted = arrays['subtracted']
+	if data.storage == 'sparse':
+		data.set_chambers(arrays['chambers'])
+	data.luminosity = arrays['luminosity']
+	data.timestamps = arrays['timestamps']
+	data._subtracted = subtracted
+
+# shared memory blocks attached by clients, kept open until the process exits
+# (arrays do not keep blocks open, closing a block while arrays use it would crash the process)
+attached = []
+
+# attach existing shared memory block (not removed when this process exits)
+def attach_block(name):
+	try:
+		block = shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:# python < 3.13: block is registered in the resource tracker, which would remove it at exit
+		block = shared_memory.SharedMemory(name=name)
+		from multiprocessing import resource_tracker
+		resource_tracker.unregister(block._name, 'shared_memory')
+	attached.append(block)
+	return block
+
+# serves loaded fills, least recently used fills are dropped when max_loaded fills are loaded
+class DTCurrentServer(object):
+	def __init__(self, address=SOCKET, max_loaded=8, **options):
+		self.address = address
+		self.max_loaded = max_loaded
+		
+		# options passed to DTCurrentData (eg. storage, dtype)
+		self.options = options
+		
+		# path: (data, shared memory blocks, fill info)
+		self.fills = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.server = None
+	
+	# load fill (if it is not loaded yet) and publish its arrays, returns fill info
+	def load(self, path):
+		if shared_memory is None:
+			print('DTCurrentServer needs python 3.8 or newer (multiprocessing.shared_memory)')
+			return
+		path = os.path.abspath(path.rstrip('/'))+'/'
+		if path in self.fills:
+			self.fills[path] = self.fills.pop(path)
+			return self.fills[path][2]
+		
+		data = DTCurrentData.DTCurrentData(path, **self.options)
+		if not data.loaded:
+			return
+		blocks, arrays = share(data)
+		info = {'path': path, 'fill': data.fill, 'storage': data.storage, 'dtype': data.dtype.str, 'arrays': arrays,
+			'wheels': data.wheels.tolist(), 'stations': data.stations.tolist(), 'sectors': data.sectors.tolist()}
+		self.fills[path] = (data, blocks, info)
+		
+		while len(self.fills) > max(self.max_loaded, 1):
+			self.unload(next(iter(self.fills)))
+		return info
+	
+	# drop fill, shared memory of attached views stays valid until the client processes exit
+	def unload(self, path):
+		path = os.path.abspath(path.rstrip('/'))+'/'
+		if path not in self.fills:
+			return
+		data, blocks, _ = self.fills.pop(path)
+		data.memo.clear()
+		for block in blocks:
+			block.unlink()
+			block.close()
+	
+	# answer one request: {'command': 'load'|'query'|'unload'|'fills', 'path': ..., 'method': ..., 'filters': {...}}
+	def handle(self, request):
+		command = request.get('command')
+		with self.lock:
+			if command == 'fills':
+				return {'result': list(self.fills)}
+			if command == 'unload':
+				self.unload(request['path'])
+				return {'result': None}
+			if command not in ('load', 'query'):
+				return {'error': 'unknown command {command}'.format(command=command)}
+			
+			info = self.load(request['path'])
+			if info is None:
+				return {'error': 'could not load {path}'.format(path=request['path'])}
+			if command == 'load':
+				return {'result': info}
+			
+			method = request.get('method')
+			if method not in QUERIES:
+				return {'error': 'unknown query {method}'.format(method=method)}
+			filters = dict((name, tuple(value) if isinstance(value, list) else value) for name, value in request.get('filters', {}).items())
+			data = self.fills[info['path']][0]
+			return {'result': encode(getattr(data, method)(**filters))}
+	
+	# answer requests until shutdown() is called (or the process is interrupted)
+	def serve(self):
+		if shared_memory is None:
+			print('DTCurrentServer needs python 3.8 or newer (multiprocessing.shared_memory)')
+			return
+		if os.path.exists(self.address):
+			os.remove(self.address)
+		self.server = ThreadingUnixServer(self.address, RequestHandler)
+		self.server.dtcurrent = self
+		print('Serving on {address}'.format(address=self.address))
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			os.remove(self.address)
+			for path in list(self.fills):
+				self.unload(path)
+	
+	# stop serve() (from another thread)
+	def shutdown(self):
+		if self.server is not None:
+			self.server.shutdown()
+
+if socketserver is not None:
+	# one thread for each client connection, queries are answered one at a time
+	class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+		daemon_threads = True
+	
+	# requests and responses are json lines
+	class RequestHandler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				try:
+					response = self.server.dtcurrent.handle(json.loads(line.decode('utf-8')))
+				except Exception as e:
+					response = {'error': '{name}: {error}'.format(name=type(e).__name__, error=e)}
+				self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+# connection to a running DTCurrentServer
+class DTCurrentClient(object):
+	def __init__(self, address=SOCKET):
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.connect(address)
+		self.fp = self.socket.makefile('rwb')
+	
+	# send request, returns result or None if the server returned an error
+	def request(self, **request):
+		self.fp.write((json.dumps(request) + '\n').encode('utf-8'))
+		self.fp.flush()
+		response = json.loads(self.fp.readline().decode('utf-8'))
+		if 'error' in response:
+			print(response['error'])
+			return
+		return response['result']
+	
+	# load fill in the server, returns fill info
+	def load(self, path):
+		return self.request(command='load', path=os.path.abspath(path))
+	
+	# run DTCurrentData method (one of QUERIES) in the server, eg. query('fills/4364/', 'slope', station=4)
+	def query(self, path, method, **filters):
+		return decode(self.request(command='query', path=os.path.abspath(path), method=method, filters=filters))
+	
+	# drop fill from the server
+	def unload(self, path):
+		return self.request(command='unload', path=os.path.abspath(path))
+	
+	# paths of fills loaded in the server
+	def fills(self):
+		return self.request(command='fills')
+	
+	# DTCurrentData using the shared arrays of the fill (read only, nothing is parsed or copied)
+	def attach(self, path, **options):
+		if shared_memory is None:
+			print('Attaching needs python 3.8 or newer (multiprocessing.shared_memory)')
+			return
+		info = self.load(path)
+		if info is None:
+			return
+		data = DTCurrentData.DTCurrentData(storage=info['storage'], dtype=info['dtype'], **options)
+		arrays = {}
+		for name, (block_name, shape, dtype) in info['arrays'].items():
+			arrays[name] = np.ndarray(tuple(shape), dtype=dtype, buffer=attach_block(block_name).buf)
+		set_arrays(data, arrays)
+		data.path = info['path']
+		data.fill = info['fill']
+		data.wheels = np.array(info['wheels'], dtype=int)
+		data.stations = np.array(info['stations'], dtype=int)
+		data.sectors = np.array(info['sectors'], dtype=int)
+		data.loaded = True
+		return data
+	
+	# close connection (attached views can still be used)
+	def close(self):
+		self.fp.close()
+		self.socket.close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve DT current fills from shared memory over a unix socket')
+	parser.add_argument('paths', nargs='*', help='fills loaded at start')
+	parser.add_argument('--socket', default=SOCKET)
+	parser.add_argument('--max-loaded', type=int, default=8)
+	parser.add_argument('--storage', default='masked')
+	args = parser.parse_args()
+	
+	# shared memory is removed also when the server is terminated
+	signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+	
+	server = DTCurrentServer(args.socket, max_loaded=args.max_loaded, storage=args.storage)
+	for path in args.paths:
+		server.load(path)
+	try:
+		server.serve()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,239 @@
+import DTCurrentData
+import numpy as np
+
+# follows growing chamber files of a running fill, each poll parses only new lines and updates fit sums with new rows
+# usage:
+# stream = DTCurrentStream('fills/running/')
+# stream.poll()# call periodically
+# stream.slope(wheel=2, station=4, sector=4, superlayer=1, layer=1, wire='wire0')
+
+class ChamberStream(object):
+	def __init__(self, filename, fast=True):
+		self.filename = filename
+		self.fast = fast
+		
+		# bytes read from file (only complete lines are read)
+		self.offset = 0
+		self.header = None
+		self.columns = 0
+		self.valid = True
+		
+		# background current (mean of ON rows before luminosity exceeds 10), None until luminosity exceeds 10
+		self.background = None
+		self.bg_sum = 0.
+		self.bg_rows = 0
+		
+		# rows since luminosity peak (rows before the peak are removed like in DTCurrentData)
+		self.peak = -np.inf
+		self.rows = 0
+		self.luminosity = np.zeros(0)
+		self.timestamps = np.zeros(0, dtype=np.int64)
+		self.currents = np.zeros((0, 0))
+		
+		# fit sums of rows already checked for outliers and maximum of each series
+		self.sums = None
+		self.processed = 0
+		self.maxima = None
+	
+	# read new complete lines, returns number of new ON rows
+	def poll(self):
+		if not self.valid:
+			return 0
+		with open(self.filename, 'rb') as fp:
+			fp.seek(self.offset)
+			text = fp.read()
+		end = text.rfind(b'\n') + 1
+		text = text[:end].decode('latin-1')
+		
+		if self.header is None:
+			# header and tabs info lines
+			lines = text.split('\n', 2)
+			if len(lines) < 3:
+				return 0
+			self.header = DTCurrentData.parse_header(lines[0], self.filename)
+			if self.header is None:
+				self.valid = False
+				return 0
+			self.columns = len(lines[1].split())
+			text = lines[2]
+		self.offset += end
+		
+		if not text.strip():
+			return 0
+		timestamps, luminosity, currents = DTCurrentData.parse_rows(text, self.columns, fast=self.fast)
+		self.add_rows(luminosity, currents.reshape((len(luminosity), self.columns - 4)), timestamps)
+		return len(luminosity)
+	
+	# fitted series of currents: every channel and wires mean ((wire0 + wire1) / 2) of every layer
+	def series(self, currents):
+		layers = currents.reshape(currents.shape[:-1] + (-1, 3))
+		return np.concatenate((currents, (layers[..., 0] + layers[..., 1]) * 0.5), axis=-1)
+	
+	# add ON rows
+	def add_rows(self, luminosity, currents, timestamps):
+		if not len(luminosity):
+			return
+		
+		# calculate background current (bg=mean values where state=ON and luminosity<10 at the beginning)
+		if self.background is None:
+			above = np.flatnonzero(luminosity > 10)
+			bgrows = above[0] if len(above) else len(luminosity)
+			self.bg_sum = self.bg_sum + currents[:bgrows].sum(0)
+			self.bg_rows += bgrows
+			if len(above):
+				with np.errstate(invalid='ignore', divide='ignore'):
+					self.background = self.series(self.bg_sum / self.bg_rows)
+		
+		# remove rows before new luminosity peak
+		imax = np.argmax(luminosity)
+		if luminosity[imax] > self.peak:
+			self.peak = luminosity[imax]
+			luminosity = luminosity[imax:]
+			currents = currents[imax:]
+			timestamps = timestamps[imax:]
+			self.rows = 0
+			self.sums = None
+			self.processed = 0
+			self.maxima = None
+		
+		# append rows (capacity is doubled when full)
+		rows = self.rows + len(luminosity)
+		if rows > len(self.luminosity):
+			capacity = max(rows, 2 * len(self.luminosity))
+			self.luminosity = np.concatenate((self.luminosity[:self.rows], np.zeros(capacity - self.rows)))
+			self.timestamps = np.concatenate((self.timestamps[:self.rows], np.zeros(capacity - self.rows, dtype=np.int64)))
+			self.currents = np.concatenate((self.currents[:self.rows].reshape((-1, currents.shape[1])), np.zeros((capacity - self.rows, currents.shape[1]))))
+		self.luminosity[self.rows:rows] = luminosity
+		self.timestamps[self.rows:rows] = timestamps
+		self.currents[self.rows:rows] = currents
+		self.rows = rows
+		
+		maxima = self.series(currents).max(0)
+		self.maxima = maxima if self.maxima is None else np.maximum(self.maxima, maxima)
+		
+		self.process()
+	
+	# add rows to fit sums, last two rows are not added (their outlier check depends on the number of rows)
+	def process(self):
+		end = self.rows - 2
+		if self.background is None or end <= self.processed:
+			return
+		start = self.processed
+		first = max(start - 1, 0)
+		
+		# rows first..end (including neighbours of processed rows)
+		currents = (self.series(self.currents[first:end+1]) - self.background).T
+		
+		# remove points that differs more than 0.02*3 from nearby values mean (outliers), first row is always kept
+		outliers = (currents[:, 1:-1]*2 - currents[:, :-2] - currents[:, 2:]) < 0.02 * 3
+		
+		# fit only values above 0
+		currents = currents[:, start-first:-1]
+		mask = currents > 0
+		if start == 0:
+			mask[:, 1:] &= outliers
+		else:
+			mask &= outliers
+		
+		sums = DTCurrentData.line_sums(self.luminosity[start:end], currents, mask)
+		self.sums = sums if self.sums is None else DTCurrentData.merge_sums(self.sums, sums)
+		self.processed = end
+	
+	# slope and intercept of each series
+	def lines(self):
+		if self.background is None or self.rows == 0:
+			return
+		
+		# last two rows: the one before the last is always kept, the last one is checked with its previous point mean
+		start = max(self.rows - 2, 0)
+		first = max(self.rows - 3, 0)
+		currents = (self.series(self.currents[first:self.rows]) - self.background).T
+		mask = currents[:, start-first:] > 0
+		if self.rows >= 3:
+			mask[:, -1] &= (currents[:, 1]*2 - currents[:, 0] - currents[:, 2]) < 0.02 * 3
+		
+		sums = DTCurrentData.line_sums(self.luminosity[start:self.rows], currents[:, start-first:], mask)
+		if self.sums is not None:
+			sums = DTCurrentData.merge_sums(self.sums, sums)
+		return DTCurrentData.sums_to_lines(sums)
+	
+	# chamber data in DTCurrentData.read_chamber format
+	def chamber(self):
+		if self.header is None or self.rows == 0:
+			return
+		background = self.bg_sum / self.bg_rows if self.background is not None and self.bg_rows else np.full(self.columns - 4, np.nan)
+		return self.header + (self.luminosity[:self.rows].copy(), self.currents[:self.rows].copy(), background, self.timestamps[:self.rows].copy())
+
+class DTCurrentStream(object):
+	def __init__(self, path='', fast=True):
+		self.path = path.rstrip('/')+'/'
+		self.fast = fast
+		self.streams = {}
+		
+		self.valid_superlayers = np.array([1,2,3])
+		self.valid_layers = np.array([1,2,3,4])
+		self.valid_wires = ["wire0", "wire1", "cathode"]
+	
+	# look for new files and read new lines of all files, returns number of new ON rows
+	def poll(self):
+		rows = 0
+		for filename in DTCurrentData.data_files(self.path):
+			if not filename.endswith('.txt'):# compressed files and archives can not be followed
+				continue
+			if filename not in self.streams:
+				self.streams[filename] = ChamberStream(filename, fast=self.fast)
+			rows += self.streams[filename].poll()
+		return rows
+	
+	# return stream of the chamber and index of the series
+	def find(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		if None in (wheel, station, sector, superlayer, layer):
+			print("stream queries need wheel, station, sector, superlayer and layer values, use data() for other queries")
+			return
+		if superlayer not in self.valid_superlayers or layer not in self.valid_layers:
+			print("superlayer value should be 1|2|3, layer value should be 1|2|3|4")
+			return
+		
+		for stream in self.streams.values():
+			if stream.header is not None and tuple(stream.header[1:]) == (wheel, station, sector):
+				channels = stream.columns - 4
+				if (superlayer-1) * 12 >= channels:# MB4 has only 2 superlayers
+					return
+				if wire == "wires":
+					return (stream, channels + (superlayer-1) * 4 + layer-1)
+				if wire in self.valid_wires:
+					return (stream, ((superlayer-1) * 4 + layer-1) * 3 + self.valid_wires.index(wire))
+				print("wire value should be wire0|wire1|wires|cathode")
+				return
+	
+	# return slope: d(current)/d(luminosity) of one channel
+	def slope(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		found = self.find(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if found is None:
+			return
+		stream, series = found
+		lines = stream.lines()
+		if lines is None:
+			return 0.
+		return float(lines[0][series])
+	
+	# return max current of one channel
+	def maxcurrent(self, wheel=None, station=None, sector=None, superlayer=None, layer=None, wire='wires'):
+		found = self.find(wheel=wheel, station=station, sector=sector, superlayer=superlayer, layer=layer, wire=wire)
+		if found is None:
+			return
+		stream, series = found
+		if stream.maxima is None:
+			return
+		return float(stream.maxima[series])
+	
+	# return DTCurrentData with rows read so far (for queries over several channels)
+	def data(self, **options):
+		data = DTCurrentData.DTCurrentData(**options)
+		data.path = self.path
+		data.insert_chambers([self.streams[filename].chamber() for filename in sorted(self.streams)])
+		if data.currents is None:
+			return
+		data.loaded = True
+		data.find_locations()
+		return data
@@ -0,0 +1,13 @@
+from DTCurrentFillSet import *
+import matplotlib.pyplot as plt
+
+# fills are loaded when they are used
+fills = DTCurrentFillSet('fills/*/')
+
+# slope vs fill number for one chamber
+xs, ys = fills.slope_vs_fill(wheel=2, station=4, sector=4, wire='cathode')
+plt.plot(xs, ys, 'o')
+plt.show()
+
+# one fit over selected fills
+print(fills.slope(fills=[4364, 4381], station=4))
\ No newline at end of file